@@ -1,7 +1,9 @@
+import asyncio
 import threading
-import queue
-import json
+import collections
 import logging
+import time
+import orjson
 from typing import Optional, Any
 
 logging.basicConfig(level=logging.INFO)
@@ -12,19 +14,49 @@ class Message:
     A single message in the message bus.
     """
 
+    # Histories hold many messages, so skip the per-instance __dict__
+    __slots__ = ("_role", "_content", "_json", "_dict")
+
     def __init__(self, role: str, content: str):
-        self.role = role  # "user", "assistant", or "system"
-        self.content = content  # The message content, a string
+        self._role = role  # "user", "assistant", or "system"
+        self._content = content  # The message content, a string
+        self._json = None  # Cached result of to_json
+        self._dict = None  # Cached result of to_dict
+
+    @property
+    def role(self) -> str:
+        return self._role
+
+    @role.setter
+    def role(self, role: str):
+        self._role = role
+        self._json = None
+        self._dict = None
+
+    @property
+    def content(self) -> str:
+        return self._content
+
+    @content.setter
+    def content(self, content: str):
+        self._content = content
+        self._json = None
+        self._dict = None
 
     def to_json(self) -> str:
-        return json.dumps({"role": self.role, "content": self.content})
+        if self._json is None:
+            self._json = orjson.dumps({"role": self._role, "content": self._content}).decode()
+        return self._json
 
     def to_dict(self) -> dict:
-        return {"role": self.role, "content": self.content}
+        # The same dict is returned until the message changes, so it must not be modified
+        if self._dict is None:
+            self._dict = {"role": self._role, "content": self._content}
+        return self._dict
 
     @staticmethod
     def from_json(json_str: str) -> 'Message':
-        data = json.loads(json_str)
+        data = orjson.loads(json_str)
         return Message(data["role"], data["content"])
 
     def copy(self):
@@ -40,55 +72,199 @@ class Message:
         return Message(self.role, self.content)
 
 
+class Mailbox:
+    """
+    A FIFO mailbox for a single agent.
+
+    Any number of agents can put messages into it, but only the owning
+    agent takes them out. Appending to and popping from a deque are atomic,
+    so neither side needs a lock. The event is only used to wake up the
+    owner when it is waiting on an empty mailbox, and only set when it is.
+
+    The mailbox is bounded so a slow consumer can't build up an unbounded
+    backlog. When it is full, the oldest message is dropped.
+    """
+
+    def __init__(self, maxlen: int = 1024):
+        self.messages = collections.deque(maxlen=maxlen)
+        self.event = threading.Event()
+        # Set by the owner before it waits, so put() can skip the Event's lock otherwise
+        self.waiting = False
+        self.closed = False
+
+    def put(self, message: Message):
+        if len(self.messages) == self.messages.maxlen:
+            logging.warning(f"Mailbox full, dropping the oldest message: {self.messages[0]}")
+        self.messages.append(message)
+        # The owner sets waiting before its last check of the deque, so either it sees
+        # this message or we see it waiting
+        if self.waiting:
+            self.event.set()
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Message]:
+        """
+        Take the oldest message out of the mailbox, waiting up to timeout
+        seconds (or forever if timeout is None) for one to arrive.
+        Returns None if no message arrived in time, or if the mailbox is
+        closed and empty.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            try:
+                return self.messages.popleft()
+            except IndexError:
+                pass
+
+            if self.closed:
+                return None
+
+            # Clear before checking again so that a put() or close() landing
+            # between the check and the wait still wakes us up.
+            self.waiting = True
+            self.event.clear()
+            if self.messages or self.closed:
+                self.waiting = False
+                continue
+
+            if deadline is None:
+                self.event.wait()
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.waiting = False
+                    return None
+                self.event.wait(remaining)
+            self.waiting = False
+
+    def close(self):
+        """
+        Close the mailbox, waking up the owner if it is waiting for a message.
+        """
+        self.closed = True
+        self.event.set()
+
+
+class AsyncMailbox:
+    """
+    A FIFO mailbox for a single agent running on an asyncio event loop, see AsyncAgent.
+
+    It behaves like Mailbox, except that get() is a coroutine. Messages must be
+    put from the same event loop, which runs everything on one thread, so the
+    event can be set on every put() without any lock.
+    """
+
+    def __init__(self, maxlen: int = 1024):
+        self.messages = collections.deque(maxlen=maxlen)
+        self.event = asyncio.Event()
+        self.closed = False
+
+    def put(self, message: Message):
+        if len(self.messages) == self.messages.maxlen:
+            logging.warning(f"Mailbox full, dropping the oldest message: {self.messages[0]}")
+        self.messages.append(message)
+        self.event.set()
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[Message]:
+        """
+        Take the oldest message out of the mailbox, waiting up to timeout
+        seconds (or forever if timeout is None) for one to arrive.
+        Returns None if no message arrived in time, or if the mailbox is
+        closed and empty.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+
+        while True:
+            if self.messages:
+                return self.messages.popleft()
+
+            if self.closed:
+                return None
+
+            # Nothing else runs until the next await, so clearing can't lose a put()
+            self.event.clear()
+
+            if deadline is None:
+                await self.event.wait()
+            else:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return None
+                try:
+                    await asyncio.wait_for(self.event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    return None
+
+    def close(self):
+        """
+        Close the mailbox, waking up the owner if it is waiting for a message.
+        """
+        self.closed = True
+        self.event.set()
+
+
 class MessageBus:
     """
     A message bus for communication between agents.
     """
 
     def __init__(self):
+        # Agents are registered a handful of times but messaged constantly.
+        # Registration publishes new dicts (copy-on-write) under the registry
+        # lock, so senders and receivers read a complete snapshot without locking.
         self.agent_queues = {}
         self.agents = {}
-        self.lock = threading.Lock()
+        self.registry_lock = threading.Lock()
+        # Resources are written a handful of times at startup and read by
+        # every agent. Single dict reads and assignments are atomic and
+        # nothing iterates the dict, so only writers take their own lock.
         self.resources = {}
+        self.resources_lock = threading.Lock()
         self.running = False
 
-    def register_agent(self, agent_name: str, agent: 'Agent'):
-        with self.lock:
-            if agent_name not in self.agent_queues:
-                self.agent_queues[agent_name] = queue.Queue()
-                self.agents[agent_name] = agent
+    def register_agent(self, agent_name: str, agent: 'Agent',
+                       mailbox_class: type = Mailbox) -> Mailbox | AsyncMailbox:
+        """
+        Register an agent and return its mailbox, so the agent can keep a
+        reference to it instead of looking it up on every receive.
+        """
+        with self.registry_lock:
+            mailbox = self.agent_queues.get(agent_name)
+            if mailbox is None:
+                mailbox = mailbox_class()
+                self.agents = {**self.agents, agent_name: agent}
+                self.agent_queues = {**self.agent_queues, agent_name: mailbox}
+            return mailbox
 
     def unregister_agent(self, agent_name: str):
-        with self.lock:
+        with self.registry_lock:
             if agent_name in self.agent_queues:
-                del self.agent_queues[agent_name]
-                del self.agents[agent_name]
+                # Wake up the agent if it is blocked waiting for a message
+                self.agent_queues[agent_name].close()
+                self.agent_queues = {name: mailbox for name, mailbox in self.agent_queues.items()
+                                     if name != agent_name}
+                self.agents = {name: agent for name, agent in self.agents.items() if name != agent_name}
 
     def send_message(self, to_agent: str, message: Message):
-        with self.lock:
-            if to_agent in self.agent_queues:
-                self.agent_queues[to_agent].put(message)
+        # agent_queues is never mutated in place, so the lookup needs no lock
+        agent_queue = self.agent_queues.get(to_agent)
+        if agent_queue is not None:
+            agent_queue.put(message)
 
     def receive_message(self, agent_name: str, timeout: Optional[float] = None) -> Optional[Message]:
-        with self.lock:
-            if agent_name in self.agent_queues:
-                agent_queue = self.agent_queues[agent_name]
-            else:
-                logging.warning(f"Agent '{agent_name}' not found.")
-                return None
-        try:
-            message = agent_queue.get(timeout=timeout)
-            return message
-        except queue.Empty:
+        agent_queue = self.agent_queues.get(agent_name)
+        if agent_queue is None:
+            logging.warning(f"Agent '{agent_name}' not found.")
             return None
+        return agent_queue.get(timeout=timeout)
 
     def add_resource(self, resource_name: str, value: Any):
-        with self.lock:
+        with self.resources_lock:
             self.resources[resource_name] = value
 
     def get_resource(self, resource_name: str) -> Any:
-        with self.lock:
-            return self.resources.get(resource_name, None)
+        return self.resources.get(resource_name, None)
 
     def start_agents(self):
         self.running = True
@@ -97,8 +273,7 @@ class MessageBus:
 
     def stop_agents(self):
         self.running = False
-        agent_values = list(self.agents.values())
-        for agent in agent_values:
+        for agent in self.agents.values():
             agent.stop()
             agent.join()
 
@@ -106,28 +281,45 @@ class MessageBus:
 class StateMachine:
     def __init__(self, initial_state: callable):
         self.state = initial_state
+        # Bumped on every state change so that other threads can detect a change by
+        # comparing an int instead of comparing (bound method) states. Attribute
+        # assignment is atomic, so reading it needs no lock.
+        self.version = 0
 
     def set_state(self, state: callable):
         self.state = state
+        self.version += 1
 
     def get_state(self) -> callable:
         return self.state
 
     def update(self, *args, **kwargs):
-        self.state = self.state(*args, **kwargs)
+        state = self.state(*args, **kwargs)
+        if state != self.state:
+            self.state = state
+            self.version += 1
 
 
 class Agent:
+    mailbox_class = Mailbox
+
     def __init__(self, name: str, message_bus: MessageBus):
         self.name = name
         self.message_bus = message_bus
-        self.message_bus.register_agent(self.name, self)
+        self.mailbox = self.message_bus.register_agent(self.name, self, self.mailbox_class)
 
     def send_message(self, to_agent: str, message: Message):
         self.message_bus.send_message(to_agent, message)
 
     def receive_message(self, timeout: Optional[float] = None) -> Optional[Message]:
-        return self.message_bus.receive_message(self.name, timeout=timeout)
+        return self.mailbox.get(timeout=timeout)
+
+    def ready_to_speak(self, history) -> bool:
+        """
+        Whether the agent has anything to contribute to the conversation in the history.
+        Routers skip agents which aren't ready instead of waiting for them to say so.
+        """
+        return True
 
     def stop(self):
         self.message_bus.unregister_agent(self.name)
@@ -138,20 +330,31 @@ class ThreadedAgent(Agent, threading.Thread):
     A class for agents that run in loops.
     """
 
+    # Loop iterations without a state change after which the loop yields to the other threads
+    IDLE_YIELD_ITERATIONS = 100
+
     def __init__(self, name: str, message_bus: MessageBus, initial_state: callable):
         threading.Thread.__init__(self)  # Initialize the threading. Must be done first.
         Agent.__init__(self, name, message_bus)  # Then initialize the Agent part.
         self.running = True
         self.sm = StateMachine(initial_state)
-        self.past_state = None
+        self.past_version = -1
 
     def run(self):
+        idle_iterations = 0
         try:
             while self.running:
-                state = self.sm.get_state()
-                if state != self.past_state:
-                    self.past_state = state
-                    # logging.info(f"{self.name}: Entered state '{state.__name__}'")
+                version = self.sm.version
+                if version != self.past_version:
+                    self.past_version = version
+                    idle_iterations = 0
+                    # logging.info(f"{self.name}: Entered state '{self.sm.state.__name__}'")
+                else:
+                    idle_iterations += 1
+                    if idle_iterations >= self.IDLE_YIELD_ITERATIONS:
+                        # Don't burn a core spinning in a state that keeps returning itself
+                        idle_iterations = 0
+                        time.sleep(0)
                 self.sm.update()
         except Exception as e:
             logging.error(f"{self.name}: {e}")
@@ -159,3 +362,35 @@ class ThreadedAgent(Agent, threading.Thread):
     def stop(self):
         self.running = False
         super().stop()
+
+
+class AsyncAgent(Agent):
+    """
+    A class for agents whose states are coroutines. Any number of them run on a
+    single asyncio event loop, e.g. with asyncio.gather(agent.run(), ...),
+    instead of each waking up its own thread for every message.
+
+    States must not block the event loop. Blocking calls have to be awaited
+    with asyncio.to_thread, or replaced with their async versions.
+    """
+
+    mailbox_class = AsyncMailbox
+
+    def __init__(self, name: str, message_bus: MessageBus, initial_state: callable):
+        super().__init__(name, message_bus)
+        self.running = True
+        self.state = initial_state
+
+    async def receive_message(self, timeout: Optional[float] = None) -> Optional[Message]:
+        return await self.mailbox.get(timeout=timeout)
+
+    async def run(self):
+        try:
+            while self.running:
+                self.state = await self.state()
+        except Exception as e:
+            logging.error(f"{self.name}: {e}")
+
+    def stop(self):
+        self.running = False
+        super().stop()
@@ -1,13 +1,130 @@
-import glob
+import asyncio
+import ctypes
+import functools
 import os
 import pyautogui
+import threading
 import time
 import re
+from ctypes import wintypes
 
+import fast_input
 from inventory_viewer import InventoryViewer
 from llm_client import LLMClient, MessageHistory
 from point_tracker import PointTracker
 
+# Matches the first point in the vision model output, e.g. <point x="12.3" y="45.6" ...>
+_COORD_RE = re.compile(r'x1?="([^"]+)"\s+y1?="([^"]+)"')
+
+SCREENSHOT_DIR = 'C:\\Users\\m\\AppData\\Roaming\\.minecraft\\screenshots'
+
+# One game tick, the shortest time Minecraft needs to react to a UI change such
+# as opening a screen, filtering the recipe book or filling the output slot.
+GAME_TICK = 0.05
+
+
+def latest_screenshot_path() -> str | None:
+    """
+    This function returns the path of the newest screenshot, or None if there are no screenshots.
+    """
+    # Minecraft names screenshots by timestamp (2024-11-10_12.34.56.png, with a _1
+    # suffix for a second one in the same second), so the newest screenshot has the
+    # largest name and no file needs to be stat'ed.
+    latest = None
+    with os.scandir(SCREENSHOT_DIR) as entries:
+        for entry in entries:
+            if entry.name.endswith('.png') and (latest is None or entry.name > latest.name):
+                latest = entry
+
+    return latest.path if latest is not None else None
+
+
+FILE_NOTIFY_CHANGE_FILE_NAME = 0x0001
+FILE_NOTIFY_CHANGE_SIZE = 0x0008
+WAIT_OBJECT_0 = 0
+
+
+class DirectoryWatcher:
+    """
+    This class waits for files to be added to or written in a directory using a
+    Win32 change notification, and falls back to short sleeps on other platforms.
+    """
+    def __init__(self, path: str):
+        self.handle = None
+
+        if fast_input.IS_WINDOWS:
+            kernel32 = ctypes.windll.kernel32
+            kernel32.FindFirstChangeNotificationW.restype = wintypes.HANDLE
+            handle = kernel32.FindFirstChangeNotificationW(
+                path, False, FILE_NOTIFY_CHANGE_FILE_NAME | FILE_NOTIFY_CHANGE_SIZE
+            )
+            if handle is None or handle == wintypes.HANDLE(-1).value:
+                raise ctypes.WinError()
+            self.handle = handle
+
+    def wait(self, timeout: float) -> None:
+        if self.handle is None:
+            time.sleep(min(timeout, 0.01))
+            return
+
+        kernel32 = ctypes.windll.kernel32
+        if kernel32.WaitForSingleObject(wintypes.HANDLE(self.handle), int(timeout * 1000)) == WAIT_OBJECT_0:
+            # Re-arm the notification for the next change
+            kernel32.FindNextChangeNotification(wintypes.HANDLE(self.handle))
+
+    def close(self):
+        if self.handle is not None:
+            ctypes.windll.kernel32.FindCloseChangeNotification(wintypes.HANDLE(self.handle))
+            self.handle = None
+
+
+def wait_for_new_screenshot(previous: str | None, timeout: float = 2.0) -> str | None:
+    """
+    This function blocks until a screenshot newer than previous has been fully written and returns
+    its path, or returns None if that doesn't happen within the timeout.
+    """
+    deadline = time.monotonic() + timeout
+    watcher = DirectoryWatcher(SCREENSHOT_DIR)
+
+    try:
+        last_size = -1
+        while True:
+            # Check the directory after the watcher is created so that a screenshot
+            # written in between is not missed
+            latest = latest_screenshot_path()
+            candidate = latest is not None and latest != previous
+
+            if candidate:
+                # The file appears before Minecraft has finished writing it, so
+                # wait until its size stops changing
+                size = os.stat(latest).st_size
+                if size > 0 and size == last_size:
+                    return latest
+                last_size = size
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+
+            # Once there is a candidate the last write may not trigger another
+            # notification, so only wait briefly before checking the size again
+            watcher.wait(min(remaining, 0.02) if candidate else remaining)
+    finally:
+        watcher.close()
+
+
+def with_input_lock(method):
+    """
+    This decorator makes the method hold the controller's input lock, so that the mouse and
+    keyboard events of concurrent API requests don't interleave.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.input_lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
 
 class MinecraftController:
     def __init__(self):
@@ -19,7 +136,17 @@ class MinecraftController:
 
         self.inventory_viewer = InventoryViewer('images')
 
+        # Created on the first look_at_point and then retargeted, so the camera and the
+        # tracking thread are only started once
+        self.tracker = None
+
+        # Reentrant because actions are composed, e.g. craft calls look_at which takes a screenshot
+        self.input_lock = threading.RLock()
+
+    @with_input_lock
     def take_screenshot(self) -> str:
+        previous = latest_screenshot_path()
+
         # press f2 to take a screenshot
         pyautogui.press('f2')
 
@@ -31,12 +158,13 @@ class MinecraftController:
         pyautogui.keyUp('f3')
         pyautogui.keyUp('d')
 
-        time.sleep(1)
+        screenshot = wait_for_new_screenshot(previous)
 
-        list_of_screenshots = glob.glob('C:\\Users\\m\\AppData\\Roaming\\.minecraft\\screenshots\\*.png')
-        latest_screenshot = max(list_of_screenshots, key=os.path.getctime)
+        if screenshot is None:
+            print("Timed out waiting for the new screenshot, using the latest one")
+            return latest_screenshot_path()
 
-        return latest_screenshot
+        return screenshot
 
     def switch_to_minecraft(self):
         pyautogui.moveTo(2890, 160, duration=0.2)
@@ -46,28 +174,29 @@ class MinecraftController:
         pyautogui.press('escape')
         time.sleep(0.1)
 
+    @with_input_lock
     def turn(self, direction: str):
         if direction == "left":
-            pyautogui.move(-60, 0, duration=0.5)
+            fast_input.move_mouse(-60, 0)
         elif direction == "right":
-            pyautogui.move(60, 0, duration=0.5)
+            fast_input.move_mouse(60, 0)
         elif direction == "down":
-            pyautogui.move(0, 50, duration=0.5)
+            fast_input.move_mouse(0, 50)
         elif direction == "up":
-            pyautogui.move(0, -50, duration=0.5)
+            fast_input.move_mouse(0, -50)
         else:
             return "Error, invalid direction. Make sure to use 'left', 'right', 'up', or 'down'."
 
         return "Success, turning in the specified direction."
 
     def point_to_pixels(self, message, width=1918, height=1016) -> (int, int):
-        coordinates = re.findall(r'x1?="(.+?)" y1?="(.+?)"', message)
+        match = _COORD_RE.search(message)
 
-        if len(coordinates) == 0:
+        if match is None:
             return 0, 0
 
-        point_raw_x = float(coordinates[0][0])
-        point_raw_y = float(coordinates[0][1])
+        point_raw_x = float(match.group(1))
+        point_raw_y = float(match.group(2))
 
         dx = round((point_raw_x / 100) * width)
         dy = round((point_raw_y / 100) * height)
@@ -81,16 +210,28 @@ class MinecraftController:
             print("No point found in input message")
             return "No point found"
 
-        tracker = PointTracker((x, y), headless=False)
+        if self.tracker is None or not self.tracker.running:
+            self.tracker = PointTracker((x, y), headless=False)
+        else:
+            self.tracker.retarget((x, y))
 
-        time.sleep(2)
+        tracker = self.tracker
 
         success = False
+        stalled = not tracker.ready.wait(timeout=2)
 
         try:
             i = 0
-            while tracker.running:
-                tx, ty = tracker.get_latest_position()
+            while tracker.running and not stalled:
+                # The default age allows for the camera's frame interval
+                position = tracker.try_get_latest_position()
+
+                # Don't keep moving based on stale coordinates
+                if position is None:
+                    stalled = True
+                    break
+
+                tx, ty = position
 
                 print(f"tx: {tx}, ty: {ty}")
 
@@ -104,7 +245,10 @@ class MinecraftController:
 
                 dx, dy = round(-dx * coeff), round(-dy * coeff)
 
-                pyautogui.move(dx, dy, duration=0.1)
+                fast_input.move_mouse(dx, dy)
+                # Give the game and the tracker a moment to catch up with the
+                # move before measuring the error again.
+                time.sleep(0.1)
 
                 i += 1
                 if i > 20:
@@ -112,15 +256,18 @@ class MinecraftController:
         except KeyboardInterrupt:
             pass
 
-        tracker.stop()
-        tracker.thread.join()
-        print("Stopped tracking")
+        tracker.pause()
+        print("Paused tracking")
 
         if success:
             return "Successfully looked at point"
+        elif stalled:
+            return "Failed to look at point, the tracker stalled"
         else:
             return "Failed to look at point"
 
+    # The whole action holds the lock since the view must not change while the model looks for the target
+    @with_input_lock
     def look_at(self, target: str):
         """
         Call the vision model to identify the object, then look at it using the look_at_point method.
@@ -153,6 +300,7 @@ class MinecraftController:
     def block_distance_to_time(self, distance: float) -> float:
         return distance / 4.317
 
+    @with_input_lock
     def move_forward(self, distance: float):
         time.sleep(0.1)
         pyautogui.keyDown('w')
@@ -161,6 +309,7 @@ class MinecraftController:
         time.sleep(0.1)
         return "Moved forward"
 
+    @with_input_lock
     def mine_block(self):
         pyautogui.mouseDown()
         time.sleep(4)
@@ -169,12 +318,13 @@ class MinecraftController:
         return "Block mined"
 
     def inventory_contains(self, item: str):
-        pyautogui.press('e')
-        time.sleep(0.1)
+        with self.input_lock:
+            pyautogui.press('e')
+            time.sleep(0.1)
 
-        screenshot_path = self.take_screenshot()
+            screenshot_path = self.take_screenshot()
 
-        pyautogui.press('e')
+            pyautogui.press('e')
 
         return self.inventory_viewer.process_inventory_image(screenshot_path)
 
@@ -201,12 +351,14 @@ class MinecraftController:
 
         return history.last()
 
+    @with_input_lock
     def interact(self, item: str):
         """
         Right click to place a block or interact with an object.
         """
         pyautogui.rightClick()
 
+    @with_input_lock
     def craft(self, item: str):
         """
         Craft the specified item.
@@ -227,22 +379,26 @@ class MinecraftController:
         time.sleep(0.1)
 
         if item.lower() in inventory_recipes:
-            pyautogui.press('e')
-            time.sleep(0.1)
-            # Search for the item in the inventory
-            pyautogui.moveTo(2496, 294, duration=0.2)
-            pyautogui.click()
-            pyautogui.write(item)
-            # Select the first result
-            pyautogui.moveTo(2333, 385, duration=0.2)
-            pyautogui.click()
-            # Take the item from the crafting output slot
-            pyautogui.moveTo(3486, 358, duration=0.2)
-            pyautogui.keyDown('shift')
-            pyautogui.click()
-            pyautogui.keyUp('shift')
-            time.sleep(0.1)
-            pyautogui.press('e')
+            fast_input.batched_click_path([
+                ("press", "e"),
+                ("sleep", GAME_TICK),
+                # Search for the item in the inventory
+                ("move", 2496, 294),
+                ("click",),
+                ("write", item),
+                ("sleep", GAME_TICK),
+                # Select the first result
+                ("move", 2333, 385),
+                ("click",),
+                ("sleep", GAME_TICK),
+                # Take the item from the crafting output slot
+                ("move", 3486, 358),
+                ("key_down", "shift"),
+                ("click",),
+                ("key_up", "shift"),
+                ("sleep", GAME_TICK),
+                ("press", "e"),
+            ])
             return "Successfully crafted item"
 
         # If the item is not craftable in the inventory, open the crafting table and craft it.
@@ -253,30 +409,40 @@ class MinecraftController:
             return "Failed to craft item, make sure to make a crafting table first"
 
         pyautogui.rightClick()
-        time.sleep(0.1)
-        # Search for the item in the crafting table recipe book
-        pyautogui.moveTo(2496, 294, duration=0.2)
-        pyautogui.click()
-        pyautogui.write(item)
-        time.sleep(0.1)
-        # Select the first result
-        pyautogui.moveTo(2333, 385, duration=0.2)
-        pyautogui.click()
-        # Take the item from the crafting table output slot
-        pyautogui.moveTo(3361, 387, duration=0.2)
-        pyautogui.keyDown('shift')
-        pyautogui.click()
-        pyautogui.keyUp('shift')
-        time.sleep(0.1)
-        pyautogui.press('e')
+        fast_input.batched_click_path([
+            ("sleep", GAME_TICK),
+            # Search for the item in the crafting table recipe book
+            ("move", 2496, 294),
+            ("click",),
+            ("write", item),
+            ("sleep", GAME_TICK),
+            # Select the first result
+            ("move", 2333, 385),
+            ("click",),
+            ("sleep", GAME_TICK),
+            # Take the item from the crafting table output slot
+            ("move", 3361, 387),
+            ("key_down", "shift"),
+            ("click",),
+            ("key_up", "shift"),
+            ("sleep", GAME_TICK),
+            ("press", "e"),
+        ])
         return "Successfully crafted item"
 
-    def main(self):
+    async def main(self):
+        """
+        Interactive loop for testing look_at_point. Input, the LLM call and the tracking run off the event
+        loop so the prompt for the next message appears while the previous point is still being tracked.
+        """
+        loop = asyncio.get_running_loop()
+        tracking = None
+
         while True:
             history = MessageHistory()
             history.add("system", "You are a helpful assistant playing the game Minecraft.")
 
-            message = input("USER: ")
+            message = await loop.run_in_executor(None, input, "USER: ")
 
             if message == "exit":
                 break
@@ -286,15 +452,22 @@ class MinecraftController:
 
             history.add("user", message)
 
-            history = self.llm_client.invoke(history)
+            history = await asyncio.to_thread(self.llm_client.invoke, history)
 
             role = history.last_role()
             msg = history.last()
             print(f"{role.upper()}: {msg}")
 
+            # Only one tracker can move the mouse at a time
+            if tracking is not None:
+                await tracking
+
             self.switch_to_minecraft()
 
-            self.look_at_point(msg)
+            tracking = asyncio.create_task(asyncio.to_thread(self.look_at_point, msg))
+
+        if tracking is not None:
+            await tracking
 
 
 """
@@ -379,4 +552,6 @@ def api_craft():
 
 
 if __name__ == '__main__':
-    app.run(host="0.0.0.0", port=4321, debug=True)
+    from waitress import serve
+
+    serve(app, host="0.0.0.0", port=4321, threads=8)
@@ -4,15 +4,83 @@ discussion. This should help improve context and coherence, allowing
 agents to better understand and critique each other's arguments.
 However, this is done at the cost of the compartmentalization of agents.
 """
+import logging
+import os
+import re
+import sys
 import time
 
+import httpx
+from openai import DefaultHttpxClient
 from termcolor import colored
 from typing import Literal
 
 from agent_base import ThreadedAgent, MessageBus, Message
-from llm_client import LLMClient, MessageHistory
+from llm_client import (
+    UNAVAILABLE_ERRORS, CachedLLMClient, CircuitOpenError, LLMClient, MessageHistory, SemanticCache,
+)
+from llm_tools import is_tool_call_complete
 import mine_tools
 
+class ColorHandler(logging.StreamHandler):
+    """
+    A log handler which writes each record in the color passed along with it,
+    e.g. log.info(message, extra={"color": "green"}). The ANSI codes of each
+    color are only built once.
+    """
+
+    def __init__(self, stream=None):
+        super().__init__(stream or sys.stdout)
+        self.color_codes = {}
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = super().format(record)
+
+        color = getattr(record, "color", None)
+        if color is None:
+            return message
+
+        codes = self.color_codes.get(color)
+        if codes is None:
+            # colored wraps the text in the start and reset codes (or nothing if colors are disabled)
+            codes = self.color_codes.setdefault(color, tuple(colored("\0", color).split("\0")))
+
+        return codes[0] + message + codes[1]
+
+
+# The agents log the conversation through one handler, so the output of agents
+# running in parallel doesn't interleave within a line
+log = logging.getLogger("conv_agent")
+log.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+log.addHandler(ColorHandler())
+log.propagate = False
+
+# The phrases the agents react to, found case-insensitively in a single pass
+# instead of lowercasing a copy of the response for every phrase
+SENTINELS = re.compile(r"plan complete|task complete|waiting|11", re.IGNORECASE)
+LONGEST_SENTINEL = len("plan complete")
+
+# Seconds to wait before retrying a request that failed because the LLM server was unavailable
+LLM_RETRY_DELAY = 5.0
+
+
+def wait_for_llm(agent: str, error: Exception) -> None:
+    """
+    Log that the LLM server couldn't be reached and wait before the agent retries.
+    The agents retry their current state, instead of dying, so that the others
+    aren't left waiting for them forever.
+    """
+    delay = error.retry_after if isinstance(error, CircuitOpenError) else LLM_RETRY_DELAY
+    log.warning(f"{agent}: LLM unavailable, retrying in {delay:.1f}s: {error}")
+    time.sleep(delay)
+
+
+def scan_sentinels(text: str) -> set[str]:
+    """
+    Returns the (lowercase) sentinel phrases found in the text.
+    """
+    return {match.lower() for match in SENTINELS.findall(text)}
+
 
 class ChatAgent(ThreadedAgent):
     """
@@ -40,21 +108,27 @@ class ChatAgent(ThreadedAgent):
         self.llm: LLMClient = self.message_bus.get_resource(llm_name)
         self.history: MessageHistory = self.message_bus.get_resource("history")
 
-        self.history.add("system_" + self.name, system_prompt)
+        self.history.set_system_prompt(self.name, system_prompt)
 
         self.text_color = text_color
 
     def chat(self):
-        last_message = self.receive_message(timeout=1)
+        last_message = self.receive_message()
 
         if last_message is None:
             return self.chat
 
-        self.history = self.llm.invoke(self.history, agent=self.name)
-        self.history.set_last_role(self.name)
+        return self.respond
+
+    def respond(self):
+        try:
+            self.history = self.llm.invoke(self.history, agent=self.name, role=self.name)
+        except UNAVAILABLE_ERRORS as e:
+            wait_for_llm(self.name, e)
+            return self.respond
 
         last_message = self.name.upper() + ": " + self.history.last()
-        print(colored(last_message, self.text_color))
+        log.info(last_message, extra={"color": self.text_color})
 
         self.send_message("router", Message("none", "none"))
 
@@ -76,21 +150,24 @@ class Mastermind(ThreadedAgent):
             "Do not take on their roles."
         )
 
-        self.history.add("system_" + self.name, mastermind_system_prompt)
+        self.history.set_system_prompt(self.name, mastermind_system_prompt)
 
     def chat(self):
-        self.history = self.llm.invoke(self.history, agent=self.name)
-        self.history.set_last_role(self.name)
+        try:
+            self.history = self.llm.invoke(self.history, agent=self.name, role=self.name)
+        except UNAVAILABLE_ERRORS as e:
+            wait_for_llm(self.name, e)
+            return self.chat
 
         last_message = "MASTERMIND: " + self.history.last()
-        print(colored(last_message, "green"))
+        log.info(last_message, extra={"color": "green"})
 
         self.send_message("critic", Message("none", "none"))
 
         return self.wait
 
     def wait(self):
-        message = self.receive_message(timeout=1)
+        message = self.receive_message()
 
         if message is None:
             return self.wait
@@ -116,19 +193,32 @@ class Critic(ThreadedAgent):
             "take on their roles."
         )
 
-        self.history.add("system_" + self.name, critic_system_prompt)
+        self.history.set_system_prompt(self.name, critic_system_prompt)
 
         self.planning_complete = False
 
     def chat(self):
-        self.history = self.llm.invoke(self.history, agent=self.name)
-        self.history.set_last_role(self.name)
+        response = ""
+        sentinels = set()
+        try:
+            for chunk in self.llm.stream_invoke(self.history, agent=self.name):
+                response += chunk
+                # Only scan the new text, plus enough before it to catch a phrase split across chunks
+                sentinels |= scan_sentinels(response[-(len(chunk) + LONGEST_SENTINEL):])
+                # Once the plan is approved the rest of the critique isn't needed
+                if not self.planning_complete and "plan complete" in sentinels:
+                    break
+        except UNAVAILABLE_ERRORS as e:
+            wait_for_llm(self.name, e)
+            return self.chat
+
+        self.history.add(self.name, response)
 
         last_message = "CRITIC: " + self.history.last()
-        print(colored(last_message, "red"))
+        log.info(last_message, extra={"color": "red"})
 
         if not self.planning_complete:
-            if "plan complete" in self.history.last().lower():
+            if "plan complete" in sentinels:
                 self.planning_complete = True
                 return self.plan_complete
 
@@ -139,7 +229,7 @@ class Critic(ThreadedAgent):
         return self.wait
 
     def wait(self):
-        message = self.receive_message(timeout=1)
+        message = self.receive_message()
 
         if message is None:
             return self.wait
@@ -147,7 +237,7 @@ class Critic(ThreadedAgent):
         return self.chat
 
     def plan_complete(self):
-        print(colored("Plan Complete!", "blue"))
+        log.info("Plan Complete!", extra={"color": "blue"})
 
         execution_start_prompt = (
             "Great! Now that the plan is complete, work with the Actor "
@@ -158,7 +248,7 @@ class Critic(ThreadedAgent):
         )
 
         self.history.add("user", execution_start_prompt)
-        print(self.history.last())
+        log.info(self.history.last())
         self.send_message("mastermind", Message("none", "none"))
         return self.wait
 
@@ -179,29 +269,40 @@ class Actor(ThreadedAgent):
                 + mine_tools.get_tools_string()
         )
 
-        self.history.add("system_" + self.name, actor_system_prompt)
+        self.history.set_system_prompt(self.name, actor_system_prompt)
 
     def chat(self):
-        self.history = self.llm.invoke(self.history, agent=self.name)
-        self.history.set_last_role(self.name)
+        response = ""
+        try:
+            for chunk in self.llm.stream_invoke(self.history, agent=self.name):
+                response += chunk
+                # A response is a single tool call, stop generating once it is closed. A ")"
+                # can also be part of an argument, e.g. look_at('oak log (left)')
+                if ")" in chunk and is_tool_call_complete(response):
+                    break
+        except UNAVAILABLE_ERRORS as e:
+            wait_for_llm(self.name, e)
+            return self.chat
+
+        self.history.add(self.name, response)
 
         last_message = self.name.upper() + ": " + self.history.last()
-        print(colored(last_message, "yellow"))
+        log.info(last_message, extra={"color": "yellow"})
 
-        if "task complete" in self.history.last().lower():
+        if "task complete" in scan_sentinels(self.history.last()):
             exit()
 
         tool_call_result = mine_tools.exec_tool_call(self.history.last())
 
         self.history.add("user", tool_call_result)
-        print(self.history.last())
+        log.info(self.history.last())
 
         self.send_message("mastermind", Message("none", "none"))
 
         return self.wait
 
     def wait(self):
-        message = self.receive_message(timeout=1)
+        message = self.receive_message()
 
         if message is None:
             return self.wait
@@ -231,25 +332,59 @@ class Router(ThreadedAgent):
             "Do not write any plans or strategies yourself, just decide which agent speaks next."
         )
 
-        self.history.add("system_router", system_prompt)
+        self.history.set_system_prompt(self.name, system_prompt)
 
         self.agent_index = 0
         # self.agents = ["mastermind", "observer", "critic", "mover"]
         self.agents = ["mastermind", "critic", "mover"]
 
+        # Observations which arrived while an agent was speaking. They are added
+        # to the history between turns so they don't interleave with a turn.
+        self.pending_observations = []
+        self.observer_busy = False
+
+    def next_agent(self) -> str:
+        # Route the agents in a round-robin fashion, skipping agents which have
+        # nothing to contribute yet instead of spending an LLM call to find out
+        for _ in range(len(self.agents)):
+            agent = self.agents[self.agent_index]
+            self.agent_index = (self.agent_index + 1) % len(self.agents)
+            if self.message_bus.agents[agent].ready_to_speak(self.history):
+                return agent
+
+        return self.agents[0]
+
     def simple_route(self):
-        # Route the agents in a round-robin fashion
-        agent = self.agents[self.agent_index]
-        self.agent_index = (self.agent_index + 1) % len(self.agents)
+        for observation in self.pending_observations:
+            self.history.add(observation.role, observation.content)
+        self.pending_observations.clear()
+
+        agent = self.next_agent()
         self.send_message(agent, Message("none", "none"))
+
+        # The watchdog and the observer don't take turns. They work on the
+        # conversation so far in parallel with the next speaker, so their LLM
+        # calls are batched with the speaker's by the server. The observer looks
+        # at the scene while the mastermind plans, and the mastermind sees the
+        # result on its next turn.
+        self.send_message("watchdog", Message("none", "none"))
+        if agent == "mastermind" and not self.observer_busy:
+            self.observer_busy = True
+            self.send_message("observer", Message("none", "none"))
+
         return self.wait
 
     def wait(self):
-        message = self.receive_message(timeout=1)
+        message = self.receive_message()
 
         if message is None:
             return self.wait
 
+        if message.role == "observer":
+            self.pending_observations.append(message)
+            self.observer_busy = False
+            return self.wait
+
         return self.simple_route
 
 
@@ -272,8 +407,8 @@ class Critic2(ChatAgent):
         system_prompt = (
             "You are the Critic agent. You critique the plans "
             "and strategies written by the Mastermind and consider "
-            "alternative perspectives. Once the plan is good, approve it "
-            "and move on to working with the other agents in executing the plan."
+            "alternative perspectives. Once the plan is good, approve it by saying "
+            "'Plan Complete' and move on to working with the other agents in executing the plan."
         )
 
         super().__init__("critic", message_bus, "red", "llama", system_prompt)
@@ -309,16 +444,20 @@ class Observer2(ThreadedAgent):
             "Focus on details relevant to the conversation and ignore those that are not."
         )
 
-        self.history.add("system_" + self.name, system_prompt)
+        self.history.set_system_prompt(self.name, system_prompt)
+
+        # Reuse the question asked for a similar recent conversation
+        self.cache = SemanticCache()
 
     def wait(self):
-        last_message = self.receive_message(timeout=1)
+        last_message = self.receive_message()
 
         if last_message is None:
             return self.wait
 
-        self.history.start_transaction()
+        return self.observe
 
+    def observe(self):
         ask_molmo_prompt = (
             "Look at the earlier conversation to find any unanswered questions "
             "or details to gather about the Minecraft scene. Then write a short "
@@ -329,22 +468,30 @@ class Observer2(ThreadedAgent):
             "as well as the presence of any relevant objects."
         )
 
-        self.history.add("user", ask_molmo_prompt)
-        self.history = self.llm.invoke(self.history, agent=self.name)
+        # Work on a snapshot, since the current speaker is adding to the shared history meanwhile
+        history = self.history.copy()
+        history.add("user", ask_molmo_prompt)
 
-        question = self.history.last()
-        print(colored("OBSERVER: " + question, "light_yellow"))
+        # The prompt and the last 3 turns of the conversation
+        cache_key = "\n".join(str(message) for message in history.history[-4:])
+        question = self.cache.get(cache_key)
 
-        self.history.rollback()
+        if question is None:
+            try:
+                question = self.llm.invoke(history, agent=self.name).last()
+            except UNAVAILABLE_ERRORS as e:
+                wait_for_llm(self.name, e)
+                return self.observe
+            self.cache.put(cache_key, question)
+        log.info("OBSERVER: " + question, extra={"color": "light_yellow"})
 
         tool_result = mine_tools.visual_question(question)
 
-        self.history.add(self.name, tool_result)
+        last_message = self.name.upper() + ": " + tool_result
+        log.info(last_message, extra={"color": "yellow"})
 
-        last_message = self.name.upper() + ": " + self.history.last()
-        print(colored(last_message, "yellow"))
-
-        self.send_message("router", Message("none", "none"))
+        # The router adds the observation to the history once the current turn is over
+        self.send_message("router", Message(self.name, tool_result))
         return self.wait
 
 
@@ -370,10 +517,18 @@ class Watchdog(ThreadedAgent):
             "Respond with an '11' to end the conversation."
         )
 
-        self.history.add("system_" + self.name, system_prompt)
+        self.history.set_system_prompt(self.name, system_prompt)
+
+        # Reuse the score given to a similar recent conversation
+        self.cache = SemanticCache()
+
+        # The scoring call in flight, if any
+        self.pending_score = None
 
     def look(self):
-        self.history.start_transaction()
+        # Skip this round if the previous score isn't in yet
+        if self.pending_score is not None and not self.pending_score.done():
+            return self.wait
 
         look_prompt = (
             "How is the conversation going? Rate it from 1-10 or "
@@ -381,22 +536,51 @@ class Watchdog(ThreadedAgent):
             "Do not provide any other feedback, context, or information."
         )
 
-        self.history.add("user", look_prompt)
-        self.history = self.llm.invoke(self.history, agent=self.name)
-        last_message = self.history.last()
+        # Score a snapshot, since the next speaker is adding to the shared history meanwhile
+        history = self.history.copy()
+        history.add("user", look_prompt)
 
-        if "11" in last_message:
-            print("Conversation ended by Watchdog.")
-            exit()
+        # The last 3 turns of the conversation, the prompt itself never changes
+        cache_key = "\n".join(str(message) for message in history.history[-4:-1])
+        score = self.cache.get(cache_key)
 
-        print(colored("WATCHDOG: " + last_message, "cyan"))
+        # Only a real scoring call may end the conversation, never a similar earlier one
+        if score is not None and "11" not in scan_sentinels(score):
+            self.handle_score(score)
+            return self.wait
 
-        self.history.rollback()
-        self.send_message("router", Message("none", "none"))
+        # Score deterministically, which also lets an unchanged conversation hit the cache
+        # The score is one or two tokens, don't let the model ramble on
+        self.pending_score = self.llm.invoke_async(history, agent=self.name, max_tokens=3,
+                                                   temperature=0.0, stop=["\n"])
+        self.pending_score.add_done_callback(lambda future: self.score_done(future, cache_key))
         return self.wait
 
+    def score_done(self, future, cache_key: str):
+        # Runs on the LLM thread, where a raised exception would only be logged by concurrent.futures
+        error = future.exception()
+        if error is not None:
+            log.warning(f"WATCHDOG: Scoring failed: {error}")
+            return
+
+        self.handle_score(future.result().last(), cache_key)
+
+    def handle_score(self, score: str, cache_key: str | None = None):
+        ended = "11" in scan_sentinels(score)
+
+        # Only 1-10 scores are cached, see look
+        if cache_key is not None and not ended:
+            self.cache.put(cache_key, score)
+
+        if ended:
+            log.info("Conversation ended by Watchdog.")
+            self.message_bus.running = False
+            return
+
+        log.info("WATCHDOG: " + score, extra={"color": "cyan"})
+
     def wait(self):
-        last_message = self.receive_message(timeout=1)
+        last_message = self.receive_message()
 
         if last_message is None:
             return self.wait
@@ -411,6 +595,10 @@ class Mover(ThreadedAgent):
         self.llm: LLMClient = self.message_bus.get_resource("llm")
         self.history: MessageHistory = self.message_bus.get_resource("history")
 
+        # Set once the critic has approved the plan, see ready_to_speak
+        self.plan_approved = False
+        self.checked_messages = 0
+
         system_prompt = (
             "You are the Mover agent. You execute the plan written by the Mastermind. "
             "Each of your responses will contain a single tool call, starting at "
@@ -418,7 +606,18 @@ class Mover(ThreadedAgent):
             "in your responses."
         )
 
-        self.history.add("system_" + self.name, system_prompt)
+        self.history.set_system_prompt(self.name, system_prompt)
+
+    def ready_to_speak(self, history: MessageHistory) -> bool:
+        # There is nothing to execute before the plan is approved, so don't ask
+        # (and have the mover answer "waiting")
+        if not self.plan_approved:
+            new_messages = history.history[self.checked_messages:]
+            self.checked_messages = len(history.history)
+            self.plan_approved = any("plan complete" in scan_sentinels(message.content)
+                                     for message in new_messages)
+
+        return self.plan_approved
 
     def chat(self):
         self.history.start_transaction()
@@ -430,19 +629,33 @@ class Mover(ThreadedAgent):
 
         self.history.add("user", mover_prompt)
 
-        self.history = self.llm.invoke(self.history, agent=self.name, max_tokens=100)
-        self.history.set_last_role(self.name)
+        response = ""
+        # The tool call fits on one line. The closing ")" can't be a server side stop
+        # string since it would be cut from the response, so it is checked below.
+        try:
+            for chunk in self.llm.stream_invoke(self.history, agent=self.name, max_tokens=100, stop=["\n"]):
+                response += chunk
+                # A response is a single tool call, stop generating once it is closed. A ")"
+                # can also be part of an argument, e.g. look_at('oak log (left)')
+                if ")" in chunk and is_tool_call_complete(response):
+                    break
+        except UNAVAILABLE_ERRORS as e:
+            self.history.rollback()
+            wait_for_llm(self.name, e)
+            return self.chat
+
+        self.history.add(self.name, response)
 
         last_message = self.name.upper() + ": " + self.history.last()
-        print(colored(last_message, "magenta"))
+        log.info(last_message, extra={"color": "magenta"})
 
-        if "waiting" not in self.history.last().lower():
+        if "waiting" not in scan_sentinels(self.history.last()):
             tool_call_result = mine_tools.exec_tool_call(self.history.last())
 
             self.history.rollback()
 
             self.history.add("user", tool_call_result)
-            print(self.history.last())
+            log.info(self.history.last())
         else:
             self.history.rollback()
 
@@ -451,7 +664,7 @@ class Mover(ThreadedAgent):
         return self.wait
 
     def wait(self):
-        message = self.receive_message(timeout=1)
+        message = self.receive_message()
 
         if message is None:
             return self.wait
@@ -462,20 +675,36 @@ class Mover(ThreadedAgent):
 def main():
     bus = MessageBus()
 
-    llm = LLMClient(
+    # Both models are served by the same server, so share one connection pool. The agents can
+    # pause for a while between calls, so keep idle connections open longer than the default 5s.
+    http_client = DefaultHttpxClient(
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60.0)
+    )
+
+    llm = CachedLLMClient(
         url="http://localhost:1234/v1",
         model="arcee-ai/SuperNova-Medius-GGUF",
         # model="lmstudio-community/qwen2.5-14b-instruct",
+        http_client=http_client,
     )
 
-    llama = LLMClient(
+    llama = CachedLLMClient(
         url="http://localhost:1234/v1",
         model="mlx-community/Meta-Llama-3.1-8B-Instruct-4bit",
+        http_client=http_client,
     )
 
+    # Both clients share the pool, so warming up one of them is enough
+    llm.warm_up()
+
     history = MessageHistory()
 
+    # The tools come first since they are the longest part of the prompt that
+    # every agent shares, which keeps them in the server's cached prefix
     overall_system_prompt = (
+            "The tools you can use are:\n"
+            + mine_tools.get_tools_string()
+            + "\n\n"
             "You all are agents in a team playing Minecraft. "
             "Keep you responses as short and work together to complete the task. "
             "If you want some information about the scene, ask the Observer agent. "
@@ -486,9 +715,7 @@ def main():
             "for instance, visual_question('Describe the scene.'). "
             "When making a tool call, provide the function name and arguments. "
             "Including argname=value pairs is not permitted and will cause "
-            "the tool call to fail. "
-            "The tools you can use are: "
-            + mine_tools.get_tools_string()
+            "the tool call to fail."
     )
 
     history.add("system", overall_system_prompt)
@@ -518,6 +745,9 @@ def main():
 
     history.add("user", goal)
 
+    # The agents only ever append to the shared history, keep it that way
+    history.freeze_prefix()
+
     print(history)
 
     bus.start_agents()
@@ -526,6 +756,7 @@ def main():
         time.sleep(1)
 
     bus.stop_agents()
+    mine_tools.close_session()
 
 
 if __name__ == '__main__':
@@ -1,48 +1,147 @@
 from transformers import pipeline
-from PIL import Image
+from scipy.ndimage import map_coordinates
+import torch
 import cv2
 import numpy as np
+import functools
 import os
-import glob
+
+
+# The path is to the Minecraft directory on Windows when accessing from within WSL. This
+# path will need to be changed.
+SCREENSHOT_DIR = '/mnt/c/Users/m/AppData/Roaming/.minecraft/screenshots'
+
+# Allow TF32 for anything that still runs in FP32
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
+
+def latest_screenshot(directory: str = SCREENSHOT_DIR) -> os.DirEntry:
+    """
+    Return the directory entry of the most recently modified screenshot in the directory.
+    """
+    # scandir caches the stat result of each entry, so every file is only stat'ed once
+    with os.scandir(directory) as entries:
+        return max((entry for entry in entries if entry.name.endswith('.png')),
+                   key=lambda entry: entry.stat().st_mtime_ns)
 
 
 class DepthEstimator:
     def __init__(self):
-        self.pipe = pipeline(task="depth-estimation", model="depth-anything/Depth-Anything-V2-Small-hf", device="cuda")
+        # The pipeline is created once and reused for every image. FP16 halves the
+        # memory traffic of the weights and runs on the tensor cores.
+        self.pipe = pipeline(
+            task="depth-estimation",
+            model="depth-anything/Depth-Anything-V2-Small-hf",
+            device="cuda",
+            torch_dtype=torch.float16,
+        )
+        self.pipe.model.eval()
+        # The graph is captured on the first call and replayed on the following ones
+        self.pipe.model = torch.compile(self.pipe.model, mode="reduce-overhead")
+
+        # Depth maps of the most recent images, keyed by (path, mtime, size) so that a
+        # file that is written again is not served from the cache
+        self._estimate_depth_cached = functools.lru_cache(maxsize=8)(self._estimate_depth_file)
+
+        # The model input is staged in a pinned host buffer, reused across calls, so the copy
+        # to the GPU is an asynchronous DMA on a dedicated stream instead of a pageable copy
+        self.stream = torch.cuda.Stream()
+        self.pinned_pixels = None
 
     def estimate_depth(self, image_path: str) -> np.ndarray:
         """
         Take the image located at the image path and generate a depth map from it.
+        The depth map is cached, so it must not be modified.
+        """
+        stat = os.stat(image_path)
+        return self._estimate_depth_cached(image_path, stat.st_mtime_ns, stat.st_size)
+
+    def _estimate_depth_file(self, image_path: str, mtime_ns: int, size: int) -> np.ndarray:
+        depth = self.estimate_depth_batch([image_path])[0]
+        # The same array is returned on every cache hit
+        depth.flags.writeable = False
+        return depth
+
+    def estimate_latest_depth(self, directory: str = SCREENSHOT_DIR) -> np.ndarray:
+        """
+        Generate a depth map from the latest screenshot in the directory. If there is no new
+        screenshot since the last call, the previous depth map is returned.
+        """
+        screenshot = latest_screenshot(directory)
+        # Reuse the stat result cached by scandir
+        stat = screenshot.stat()
+        return self._estimate_depth_cached(screenshot.path, stat.st_mtime_ns, stat.st_size)
+
+    def estimate_depth_batch(self, image_paths: list[str]) -> list[np.ndarray]:
         """
-        image = Image.open(image_path)
-        depth = self.pipe(image)["depth"]
-        depth_array = np.array(depth)
-        depth_normalized = cv2.normalize(depth_array, None, 0, 255, cv2.NORM_MINMAX)
-        depth_uint8 = depth_normalized.astype(np.uint8)
-        return depth_uint8
+        Generate the depth maps of several images with a single forward pass of the model.
+        The images must all have the same size, which is the case for screenshots.
+        """
+        # Decode the images once here instead of lazily inside the image processor
+        images = [cv2.cvtColor(cv2.imread(image_path, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+                  for image_path in image_paths]
+        return self._estimate_depth_images(images)
+
+    def warm_up(self, width: int = 1920, height: int = 1080, batch_size: int = 1):
+        """
+        Run the model once on blank images so that CUDA initialization and compilation
+        don't slow down the first real call.
+        """
+        self._estimate_depth_images([np.zeros((height, width, 3), dtype=np.uint8)] * batch_size)
+
+    def _estimate_depth_images(self, images: list[np.ndarray]) -> list[np.ndarray]:
+        pixel_values = self.pipe.image_processor(images=images, return_tensors="pt")["pixel_values"]
+        # The buffer is only reallocated when the batch size or the resolution changes
+        if self.pinned_pixels is None or self.pinned_pixels.shape != pixel_values.shape:
+            self.pinned_pixels = torch.empty(pixel_values.shape, dtype=torch.float16, pin_memory=True)
+        self.pinned_pixels.copy_(pixel_values)
+
+        with torch.inference_mode(), torch.cuda.stream(self.stream):
+            pixel_values = self.pinned_pixels.to(self.pipe.device, non_blocking=True)
+            predicted_depth = self.pipe.model(pixel_values=pixel_values).predicted_depth
+
+            # Resize to the image size and normalize each map to 0-255 on the GPU, so only
+            # the final uint8 maps are copied back instead of several full size float copies
+            depth = torch.nn.functional.interpolate(
+                predicted_depth.unsqueeze(1), size=images[0].shape[:2], mode="bicubic",
+                align_corners=False
+            )[:, 0].float()
+            depth_min = depth.amin(dim=(1, 2), keepdim=True)
+            depth_max = depth.amax(dim=(1, 2), keepdim=True)
+            depth_uint8 = ((depth - depth_min) * (255.0 / (depth_max - depth_min).clamp_min(1e-6))).to(torch.uint8)
+
+            # Copying to pageable memory waits for the stream, so the pinned buffer is free
+            # to be reused by the next call
+            depth_uint8 = depth_uint8.cpu()
+
+        return list(depth_uint8.numpy())
 
     def get_depth_at_fractional_point(self, depth_array: np.ndarray, x: float, y: float) -> float:
         """
         Given a depth map and a fractional point (a point with x and y coordinates between 0 and 1),
         this function returns the depth at that fractional point.
         """
+        return float(self.get_depth_at_fractional_points(depth_array, np.array([x]), np.array([y]))[0])
+
+    def get_depth_at_fractional_points(self, depth_array: np.ndarray, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """
+        Given a depth map and arrays of fractional x and y coordinates (between 0 and 1), this
+        function returns the bilinearly interpolated depth at all the points in one call.
+        """
         height, width = depth_array.shape
-        x = int(x * width)
-        y = int(y * height)
-        return (255 - int(depth_array[y, x])) / 10
+        # Pixel centers are at half pixel offsets from the fractional coordinates
+        coordinates = np.vstack([ys * height - 0.5, xs * width - 0.5])
+        values = map_coordinates(depth_array.astype(np.float32), coordinates, order=1, mode="nearest")
+        return (255 - values) / 10
 
 
 def main():
     depth_estimator = DepthEstimator()
+    depth_estimator.warm_up()
 
-    # Get the latest Minecraft screenshot
-    # The path is to the Minecraft directory on Windows when accessing from within WSL. This
-    # path will need to be changed.
-    list_of_screenshots = glob.glob('/mnt/c/Users/m/AppData/Roaming/.minecraft/screenshots/*.png')
-    latest_screenshot = max(list_of_screenshots, key=os.path.getctime)
-
-    # Estimate the depth
-    depth = depth_estimator.estimate_depth(latest_screenshot)
+    # Estimate the depth of the latest Minecraft screenshot
+    depth = depth_estimator.estimate_latest_depth()
 
     # Write the depth data to a file
     cv2.imwrite("depth.png", depth)
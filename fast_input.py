@@ -0,0 +1,236 @@
+"""
+Low latency mouse and keyboard input using the Win32 SendInput API.
+
+pyautogui moves the mouse by interpolating in Python and sleeping between
+steps, so a move with a duration blocks for that long no matter how fast
+the OS could deliver it. SendInput delivers any number of input events in
+a single call instead. Off Windows, the functions fall back to instant
+pyautogui calls so the controller can still be imported and tested.
+"""
+import sys
+import time
+import ctypes
+from ctypes import wintypes
+
+import pyautogui
+
+IS_WINDOWS = sys.platform == "win32"
+
+INPUT_MOUSE = 0
+INPUT_KEYBOARD = 1
+
+MOUSEEVENTF_MOVE = 0x0001
+MOUSEEVENTF_LEFTDOWN = 0x0002
+MOUSEEVENTF_LEFTUP = 0x0004
+MOUSEEVENTF_VIRTUALDESK = 0x4000
+MOUSEEVENTF_ABSOLUTE = 0x8000
+
+KEYEVENTF_KEYUP = 0x0002
+KEYEVENTF_UNICODE = 0x0004
+
+SM_XVIRTUALSCREEN = 76
+SM_YVIRTUALSCREEN = 77
+SM_CXVIRTUALSCREEN = 78
+SM_CYVIRTUALSCREEN = 79
+
+# Virtual key codes for the named keys used by the controller. Single
+# characters are looked up with VkKeyScanW instead.
+VIRTUAL_KEYS = {
+    "shift": 0x10,
+    "escape": 0x1B,
+    "f1": 0x70,
+    "f2": 0x71,
+    "f3": 0x72,
+}
+
+
+class MOUSEINPUT(ctypes.Structure):
+    _fields_ = [
+        ("dx", wintypes.LONG),
+        ("dy", wintypes.LONG),
+        ("mouseData", wintypes.DWORD),
+        ("dwFlags", wintypes.DWORD),
+        ("time", wintypes.DWORD),
+        ("dwExtraInfo", ctypes.c_size_t),
+    ]
+
+
+class KEYBDINPUT(ctypes.Structure):
+    _fields_ = [
+        ("wVk", wintypes.WORD),
+        ("wScan", wintypes.WORD),
+        ("dwFlags", wintypes.DWORD),
+        ("time", wintypes.DWORD),
+        ("dwExtraInfo", ctypes.c_size_t),
+    ]
+
+
+class HARDWAREINPUT(ctypes.Structure):
+    _fields_ = [
+        ("uMsg", wintypes.DWORD),
+        ("wParamL", wintypes.WORD),
+        ("wParamH", wintypes.WORD),
+    ]
+
+
+class _INPUTUNION(ctypes.Union):
+    _fields_ = [("mi", MOUSEINPUT), ("ki", KEYBDINPUT), ("hi", HARDWAREINPUT)]
+
+
+class INPUT(ctypes.Structure):
+    _fields_ = [("type", wintypes.DWORD), ("union", _INPUTUNION)]
+
+
+def send_inputs(inputs: list[INPUT]) -> None:
+    """
+    Deliver a batch of INPUT events to the OS in a single SendInput call.
+    """
+    if not inputs:
+        return
+
+    array = (INPUT * len(inputs))(*inputs)
+    sent = ctypes.windll.user32.SendInput(len(inputs), array, ctypes.sizeof(INPUT))
+    if sent != len(inputs):
+        raise ctypes.WinError()
+
+
+def mouse_move_input(x: int, y: int) -> INPUT:
+    """
+    Build an event that moves the cursor to the absolute screen position (x, y).
+
+    Absolute moves are used, rather than relative ones, because relative
+    SendInput moves are scaled by the Windows pointer acceleration setting.
+    """
+    user32 = ctypes.windll.user32
+    left = user32.GetSystemMetrics(SM_XVIRTUALSCREEN)
+    top = user32.GetSystemMetrics(SM_YVIRTUALSCREEN)
+    width = user32.GetSystemMetrics(SM_CXVIRTUALSCREEN)
+    height = user32.GetSystemMetrics(SM_CYVIRTUALSCREEN)
+
+    # Absolute coordinates are normalized to 0-65535 across the virtual desktop
+    nx = round((x - left) * 65535 / max(width - 1, 1))
+    ny = round((y - top) * 65535 / max(height - 1, 1))
+
+    flags = MOUSEEVENTF_MOVE | MOUSEEVENTF_ABSOLUTE | MOUSEEVENTF_VIRTUALDESK
+    return INPUT(type=INPUT_MOUSE, union=_INPUTUNION(mi=MOUSEINPUT(nx, ny, 0, flags, 0, 0)))
+
+
+def mouse_button_input(flags: int) -> INPUT:
+    return INPUT(type=INPUT_MOUSE, union=_INPUTUNION(mi=MOUSEINPUT(0, 0, 0, flags, 0, 0)))
+
+
+def key_input(key: str, key_up: bool = False) -> INPUT:
+    """
+    Build a key down (or key up) event for a named key or a single character.
+    """
+    user32 = ctypes.windll.user32
+    if key in VIRTUAL_KEYS:
+        vk = VIRTUAL_KEYS[key]
+    else:
+        vk = user32.VkKeyScanW(ord(key)) & 0xFF
+
+    # Fill in the scan code as well since games often read it instead of the virtual key
+    scan = user32.MapVirtualKeyW(vk, 0)
+    flags = KEYEVENTF_KEYUP if key_up else 0
+    return INPUT(type=INPUT_KEYBOARD, union=_INPUTUNION(ki=KEYBDINPUT(vk, scan, flags, 0, 0)))
+
+
+def unicode_char_inputs(char: str) -> list[INPUT]:
+    """
+    Build the key down and key up events that type a single character, independent of the keyboard layout.
+    """
+    code = ord(char)
+    return [
+        INPUT(type=INPUT_KEYBOARD, union=_INPUTUNION(ki=KEYBDINPUT(0, code, KEYEVENTF_UNICODE, 0, 0))),
+        INPUT(type=INPUT_KEYBOARD, union=_INPUTUNION(ki=KEYBDINPUT(0, code, KEYEVENTF_UNICODE | KEYEVENTF_KEYUP, 0, 0))),
+    ]
+
+
+def step_inputs(step: tuple) -> list[INPUT]:
+    """
+    Translate a single click path step into the INPUT events that perform it.
+    """
+    action = step[0]
+    if action == "move":
+        return [mouse_move_input(step[1], step[2])]
+    elif action == "click":
+        return [mouse_button_input(MOUSEEVENTF_LEFTDOWN), mouse_button_input(MOUSEEVENTF_LEFTUP)]
+    elif action == "key_down":
+        return [key_input(step[1])]
+    elif action == "key_up":
+        return [key_input(step[1], key_up=True)]
+    elif action == "press":
+        return [key_input(step[1]), key_input(step[1], key_up=True)]
+    elif action == "write":
+        return [event for char in step[1] for event in unicode_char_inputs(char)]
+    else:
+        raise ValueError(f"Unknown click path step: {step}")
+
+
+def run_step_fallback(step: tuple) -> None:
+    action = step[0]
+    if action == "move":
+        pyautogui.moveTo(step[1], step[2])
+    elif action == "click":
+        pyautogui.click()
+    elif action == "key_down":
+        pyautogui.keyDown(step[1])
+    elif action == "key_up":
+        pyautogui.keyUp(step[1])
+    elif action == "press":
+        pyautogui.press(step[1])
+    elif action == "write":
+        pyautogui.write(step[1])
+    else:
+        raise ValueError(f"Unknown click path step: {step}")
+
+
+def batched_click_path(steps: list[tuple]) -> None:
+    """
+    Perform a scripted sequence of mouse and keyboard steps with as few SendInput calls as possible.
+
+    Steps are tuples such as ("move", x, y), ("click",), ("key_down", "shift"),
+    ("key_up", "shift"), ("press", "e") and ("write", "text"). A ("sleep", seconds)
+    step flushes the events collected so far and waits, so delays are only paid
+    where the game actually needs time to react, e.g. for a screen to open.
+    """
+    pending = []
+    for step in steps:
+        if step[0] == "sleep":
+            send_inputs(pending)
+            pending = []
+            time.sleep(step[1])
+        elif IS_WINDOWS:
+            pending.extend(step_inputs(step))
+        else:
+            run_step_fallback(step)
+
+    send_inputs(pending)
+
+
+def move_mouse(dx: int, dy: int) -> None:
+    """
+    Move the mouse by (dx, dy) pixels relative to its current position, immediately.
+    """
+    if not IS_WINDOWS:
+        pyautogui.move(dx, dy)
+        return
+
+    x, y = pyautogui.position()
+    send_inputs([mouse_move_input(x + dx, y + dy)])
+
+
+def key_down(key: str) -> None:
+    if not IS_WINDOWS:
+        pyautogui.keyDown(key)
+        return
+
+    send_inputs([key_input(key)])
+
+
+def key_up(key: str) -> None:
+    if not IS_WINDOWS:
+        pyautogui.keyUp(key)
+        return
+
+    send_inputs([key_input(key, key_up=True)])
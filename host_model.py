@@ -1,23 +1,17 @@
-import glob
+import concurrent.futures
+import cv2
 import os
-import io
 import datetime
 import numpy as np
-import matplotlib.pyplot as plt
-import xml.etree.ElementTree as ElementTree
+import orjson
 import re
 import threading
+import time
+import torch
 
-# Attempt to fix issues related to TKinter. In particular, the use of TK
-# in matplotlib causes crashes when running in a headless environment, such as WSL.
-# Therefore, we need to use the Agg backend for matplotlib.
-import matplotlib
-
-matplotlib.use('Agg')
-from matplotlib import image as mpimg
 from transformers import AutoModelForCausalLM, AutoProcessor, GenerationConfig, BitsAndBytesConfig
 from PIL import Image
-from flask import Flask, request, jsonify, render_template_string, send_file
+from flask import Flask, Response, request, render_template_string
 from llm_client import (
     MessageHistory,
 )
@@ -32,10 +26,13 @@ processor = AutoProcessor.from_pretrained(
 # Need to save it this way or else it doesn't load (some issue with the names not matching)
 # processor.save_pretrained("modelq2/allenai.Molmo-7B-D-0924.1721478b71306fb7dc671176d5c204dc7a4d27d7")
 
+# The 4-bit weights are dequantized for every matmul, so compute in bfloat16 rather than
+# the float32 default, which doubles the activation traffic and misses the tensor cores
 quantization_config = BitsAndBytesConfig(
     load_in_4bit=True,
     bnb_4bit_quant_type="fp4",
     bnb_4bit_use_double_quant=False,
+    bnb_4bit_compute_dtype=torch.bfloat16,
 )
 
 model = AutoModelForCausalLM.from_pretrained(
@@ -46,115 +43,196 @@ model = AutoModelForCausalLM.from_pretrained(
     quantization_config=quantization_config
 )
 
-image_buffer = io.BytesIO()
-done_writing = False
+# Compiling the forward pass removes most of the Python overhead of each decoding step. It is
+# opt-in because Molmo's remote code manages its own KV cache (so a static cache can't be used)
+# and compiling the 4-bit layers depends on the installed torch and bitsandbytes versions.
+COMPILE_MODEL = os.environ.get('COMPILE_MODEL') == '1'
+
+if COMPILE_MODEL:
+    # The sequence length grows with every step, so compile for dynamic shapes instead of
+    # capturing a CUDA graph per length
+    model.forward = torch.compile(model.forward, dynamic=True)
+
+# Number of tokens drafted from n-grams of the prompt at each step (0 disables prompt lookup). The
+# points and the tool calls mostly repeat tags and text which are already in the prompt, so several
+# drafted tokens are often accepted with a single forward pass. It is opt-in because it has only
+# been checked against transformers 4.45.2's assisted decoding, not against Molmo-7B-D-0924's
+# generate_from_batch, which builds its own image inputs and cache for the first step.
+PROMPT_LOOKUP_NUM_TOKENS = int(os.environ.get('PROMPT_LOOKUP_NUM_TOKENS', '0'))
+
+SCREENSHOT_DIR = '/mnt/c/Users/m/AppData/Roaming/.minecraft/screenshots'
+# Seconds a request waits for preload_screenshots before looking for a screenshot itself
+SCREENSHOT_WAIT_TIMEOUT = 1.0
+
+# PNG bytes of the latest screenshot with the points drawn on it. The bytes are immutable and
+# replaced as a whole, so they can be read from any thread without a lock.
+image_bytes = None
+image_ready = threading.Event()
+# (path, mtime) of the screenshot in image_bytes when it has no points drawn on it, else None
+plain_image_source = None
+# A single worker draws the points after each response, in order
+image_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="image")
+# Stream for copying the model inputs to the GPU
+input_stream = torch.cuda.Stream()
+
+# The newest screenshot as (path, decoded image), kept up to date by preload_screenshots
+latest_screenshot = None
+latest_screenshot_lock = threading.Lock()
+screenshot_ready = threading.Event()
+
+
+def find_newest_screenshot() -> os.DirEntry | None:
+    with os.scandir(SCREENSHOT_DIR) as entries:
+        return max((entry for entry in entries if entry.name.endswith('.png')),
+                   key=lambda entry: entry.stat().st_ctime_ns, default=None)
+
+
+def preload_screenshots(interval: float = 0.2) -> None:
+    """
+    Watch the screenshot directory and decode each new screenshot as soon as it appears, so
+    that requests don't pay for the directory scan and the PNG decode. The directory is only
+    scanned when its mtime changes, since stating every screenshot on /mnt/c is slow.
+    """
+    global latest_screenshot
+
+    last_key = None
+    last_dir_mtime = None
+    while True:
+        time.sleep(interval)
+
+        try:
+            dir_mtime = os.stat(SCREENSHOT_DIR).st_mtime_ns
+            if dir_mtime == last_dir_mtime:
+                continue
+            newest = find_newest_screenshot()
+            key = None if newest is None else (newest.path, newest.stat().st_mtime_ns)
+        except OSError:
+            # The directory or a screenshot disappeared during the scan, try again on the next pass
+            continue
+
+        if newest is not None and key != last_key:
+            try:
+                image = Image.open(newest.path)
+                image.load()
+            except OSError:
+                # The game is still writing the file. Writing it doesn't change the directory's
+                # mtime, so keep scanning until it can be decoded.
+                continue
+
+            with latest_screenshot_lock:
+                latest_screenshot = (newest.path, image)
+            screenshot_ready.set()
+            last_key = key
+
+        last_dir_mtime = dir_mtime
+
+
+def get_latest_screenshot(timeout: float = SCREENSHOT_WAIT_TIMEOUT) -> tuple[str, Image.Image]:
+    if screenshot_ready.wait(timeout):
+        with latest_screenshot_lock:
+            return latest_screenshot
+
+    # preload_screenshots hasn't found a screenshot (yet), so look for one directly
+    newest = find_newest_screenshot()
+    if newest is None:
+        raise FileNotFoundError(f"No screenshots found in {SCREENSHOT_DIR}")
+
+    image = Image.open(newest.path)
+    image.load()
+    return newest.path, image
+
+
+# Opening <point> and <points> tags, and the coordinate pairs inside them (x="..." y="..." or
+# x1="..." y1="...", x2="..." ...)
+POINT_TAG = re.compile(r'<points?\b[^>]*>')
+POINT_COORDS = re.compile(r'\bx\d*="([\d.]+)"\s+y\d*="([\d.]+)"')
 
 
 def parse_points(xml_string: str) -> list[tuple[float, float]]:
-    points = []
-
-    # Extract XML segments
-    point_segments = re.findall(r'<point.*?>.*?</point>', xml_string)
-    points_segments = re.findall(r'<points.*?>.*?</points>', xml_string)
-
-    for segment in point_segments:
-        root = ElementTree.fromstring(segment)
-        x = float(root.get('x'))
-        y = float(root.get('y'))
-        text = root.text
-        points.append((x, y))
-
-    for segment in points_segments:
-        root = ElementTree.fromstring(segment)
-        index = 1
-        while True:
-            x = root.get(f'x{index}')
-            y = root.get(f'y{index}')
-            if x is None or y is None:
-                break
-            x = float(x)
-            y = float(y)
-            text = root.text.strip()  # Assuming all points share the same text
-            points.append((x, y))
-            index += 1
-
-    return points
+    return [
+        (float(x), float(y))
+        for tag in POINT_TAG.finditer(xml_string)
+        for x, y in POINT_COORDS.findall(tag.group())
+    ]
 
 
 def draw_dot(image, point, radius):
-    y, x = np.ogrid[:image.shape[0], :image.shape[1]]
-    mask = (x - point[0]) ** 2 + (y - point[1]) ** 2 <= radius ** 2
-    image[mask] = [0.94, 0.01, 0.99, 1.0]  # Set dot color to red
+    # Only the pixels in the bounding box of the dot can be inside it
+    px, py = point
+    y0, y1 = max(0, py - radius), min(image.shape[0], py + radius + 1)
+    x0, x1 = max(0, px - radius), min(image.shape[1], px + radius + 1)
+    if y0 >= y1 or x0 >= x1:
+        return image
+
+    y, x = np.ogrid[y0:y1, x0:x1]
+    mask = (x - px) ** 2 + (y - py) ** 2 <= radius ** 2
+    image[y0:y1, x0:x1][mask] = [252, 3, 240]  # Set dot color to red (BGR)
     return image
 
 
-def generate_image(message: str) -> None:
-    global image_buffer, done_writing
+def generate_image(message: str, screenshot_path: str) -> None:
+    """
+    Draw the points in the message on the screenshot at screenshot_path, which must be the one
+    the model was given, and publish the result as image_bytes.
+    """
+    global image_bytes, plain_image_source
 
     points = parse_points(message)
 
-    done_writing = False
-
     if len(points) != 0:
         print("POINTS:", points)
 
-    list_of_screenshots = glob.glob('/mnt/c/Users/m/AppData/Roaming/.minecraft/screenshots/*.png')
-    latest_screenshot = max(list_of_screenshots, key=os.path.getctime)
-    image = mpimg.imread(latest_screenshot)  # Load your image
+    # Most responses have no points, so the image often wouldn't change
+    source = (screenshot_path, os.stat(screenshot_path).st_mtime_ns)
+    if not points and source == plain_image_source:
+        return
+
+    # Decode straight to uint8 BGR, which is also what the encoder takes
+    image = cv2.imread(screenshot_path, cv2.IMREAD_COLOR)
 
     # Get image dimensions
     height, width, _ = image.shape
 
     # global image
     # points = [(100, 100), (150, 200), (200, 300)]  # Example points
-    updated_image = image.copy()
     for point in points:
         px = int(point[0] / 100 * width)
         py = int(point[1] / 100 * height)
 
-        updated_image = np.array(updated_image)
-        updated_image = draw_dot(updated_image, (px, py), 10)
+        image = draw_dot(image, (px, py), 10)
 
-    fig, ax = plt.subplots(figsize=(32, 18))
-    ax.imshow(updated_image)
-    ax.axis('off')
-    fig.subplots_adjust(left=0, right=1, top=1, bottom=0)
-    image_buffer = io.BytesIO()
-    plt.savefig(image_buffer, format='png')
-    image_buffer.seek(0)
-    plt.close(fig)
+    # Encode the image directly at its own resolution. The lowest compression level encodes
+    # several times faster than the default, for a somewhat larger file
+    _, buffer = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    image_bytes = buffer.tobytes()
+    plain_image_source = None if points else source
+    image_ready.set()
 
-    done_writing = True
 
-
-def chatbot(messages: str) -> str:
+def generate(image: Image.Image, messages: str, max_new_tokens: int = 200) -> str:
     """
-    Call the loaded language model with the given messages and return the response.
-
-    This function should take a string of messages in the following format:
-    USER: message
-    ASSISTANT: message
-    ...
+    Run the model on the image and the messages and return the generated text.
     """
-    print(messages)
-
-    list_of_screenshots = glob.glob('/mnt/c/Users/m/AppData/Roaming/.minecraft/screenshots/*.png')
-    latest_screenshot = max(list_of_screenshots, key=os.path.getctime)
-
-    print("LATEST SCREENSHOT:", latest_screenshot)
-
     inputs = processor.process(
-        images=[Image.open(latest_screenshot)],
+        images=[image],
         text=messages,
     )
 
-    inputs = {k: v.to(model.device).unsqueeze(0) for k, v in inputs.items()}
+    # Copy the inputs from pinned memory on a separate stream so that the copies don't wait for
+    # each other, then wait for all of them at once
+    with torch.cuda.stream(input_stream):
+        inputs = {k: v.pin_memory().to(model.device, non_blocking=True).unsqueeze(0) for k, v in inputs.items()}
+    input_stream.synchronize()
+    # The inputs are used on the default stream, so their memory must not be reused before it is done
+    for v in inputs.values():
+        v.record_stream(torch.cuda.current_stream())
 
-    # generate output; maximum 200 new tokens; stop generation when <|endoftext|> is generated
+    # generate output; stop generation when <|endoftext|> is generated
     # with torch.autocast(device_type="cuda", enabled=True, dtype=torch.bfloat16):
     output = model.generate_from_batch(
         inputs,
-        GenerationConfig(max_new_tokens=200, stop_strings="<|endoftext|>"),
+        GenerationConfig(max_new_tokens=max_new_tokens, stop_strings="<|endoftext|>",
+                         prompt_lookup_num_tokens=PROMPT_LOOKUP_NUM_TOKENS or None),
         tokenizer=processor.tokenizer
     )
 
@@ -162,9 +240,36 @@ def chatbot(messages: str) -> str:
     generated_tokens = output[0, inputs['input_ids'].size(1):]
     generated_text = processor.tokenizer.decode(generated_tokens, skip_special_tokens=True)
 
+    return generated_text
+
+
+def warm_up() -> None:
+    """
+    Run the model once on a blank image so that compilation doesn't slow down the first request.
+    """
+    generate(Image.new('RGB', (1920, 1080)), "USER: Describe the image.", max_new_tokens=8)
+
+
+def chatbot(messages: str) -> str:
+    """
+    Call the loaded language model with the given messages and return the response.
+
+    This function should take a string of messages in the following format:
+    USER: message
+    ASSISTANT: message
+    ...
+    """
+    print(messages)
+
+    screenshot_path, screenshot = get_latest_screenshot()
+
+    print("LATEST SCREENSHOT:", screenshot_path)
+
+    generated_text = generate(screenshot, messages)
+
     print("MODEL:", generated_text)
 
-    threading.Thread(target=generate_image, args=[generated_text]).start()
+    image_executor.submit(generate_image, generated_text, screenshot_path)
 
     return generated_text
 
@@ -210,16 +315,12 @@ def home():
 
 @app.route('/update_image')
 def update_image():
-    if image_buffer is None or not done_writing:
-        return send_file(io.BytesIO(), mimetype='image/png')
+    # Give the first image a moment to be ready instead of answering with an empty one
+    if not image_ready.wait(timeout=0.05):
+        return Response(b'', mimetype='image/png')
 
-    # copy the image buffer
-    buf = io.BytesIO()
-    image_buffer.seek(0)
-    buf.write(image_buffer.read())
-    buf.seek(0)
-
-    response = send_file(buf, mimetype='image/png')
+    data = image_bytes
+    response = Response(data, mimetype='image/png')
     expires = datetime.datetime.now() + datetime.timedelta(seconds=60)
     response.headers['Expires'] = expires.strftime('%a, %d %b %Y %H:%M:%S GMT')
 
@@ -230,9 +331,13 @@ def update_image():
 def chat_completions():
     print("Completion request received.")
 
-    data = request.get_json()
-    if not data or "model" not in data or "messages" not in data:
-        return jsonify({"error": "Invalid request format"}), 400
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict) or "model" not in data or "messages" not in data:
+        return Response(orjson.dumps({"error": "Invalid request format"}), status=400,
+                        mimetype="application/json")
 
     model_name = "allenai/Molmo-7B-D-0924"
     messages = data["messages"]
@@ -246,21 +351,30 @@ def chat_completions():
 
     assistant_response = chatbot(message_str)
 
-    return jsonify(
-        {
-            "model": model_name,
-            "choices": [
-                {
-                    "index": 0,
-                    "message": {"role": "assistant", "content": assistant_response},
-                    "finish_reason": "stop",
-                }
-            ],
-        }
+    return Response(
+        orjson.dumps(
+            {
+                "model": model_name,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": assistant_response},
+                        "finish_reason": "stop",
+                    }
+                ],
+            }
+        ),
+        mimetype="application/json",
     )
 
 
 if __name__ == "__main__":
-    generate_image("")
+    threading.Thread(target=preload_screenshots, daemon=True).start()
+    if COMPILE_MODEL:
+        warm_up()
+    generate_image("", get_latest_screenshot()[0])
+
+    from waitress import serve
 
-    app.run(host="0.0.0.0", port=1234)
+    # Several threads so that image polling is not blocked behind a long chat completion
+    serve(app, host="0.0.0.0", port=1234, threads=8)
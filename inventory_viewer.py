@@ -1,7 +1,12 @@
+import collections
 import cv2
+import hashlib
 import numpy as np
 import os
 
+# Name of the file, in the inventory icons directory, that caches the vectors of the icons
+INVICON_CACHE_FILENAME = 'invicon_cache.npz'
+
 
 def replace_transparent_background(image):
     """
@@ -18,11 +23,11 @@ def remove_stray_pixels(mask):
     Once the inventory mask has been scaled down, remove any stray single pixels that have black neighbors on all
     four sides, ignoring diagonal neighbors.
     """
+    # Dilating with the four neighbors (but not the pixel itself) gives 255 wherever any neighbor is set,
+    # so a pixel survives the AND only if it has at least one neighbor
     kernel = np.array([[0, 1, 0], [1, 0, 1], [0, 1, 0]], dtype=np.uint8)
-    neighbor_count = cv2.filter2D(mask, -1, kernel)
-    stray_pixels = (mask == 255) & (neighbor_count == 0)
-    mask[stray_pixels] = 0
-    return mask
+    has_neighbor = cv2.dilate(mask, kernel)
+    return cv2.bitwise_and(mask, has_neighbor)
 
 
 def mask_color(image, color):
@@ -42,10 +47,11 @@ def vectorize_image(image):
     if image.shape != (16, 16, 3):
         raise ValueError('Item image must be 16 x 16 pixels to be vectorized')
 
-    # Find the histograms for all three channels
-    hist_r = np.histogram(image[:, :, 0].flatten(), bins=256, range=(0, 256))[0]
-    hist_g = np.histogram(image[:, :, 1].flatten(), bins=256, range=(0, 256))[0]
-    hist_b = np.histogram(image[:, :, 2].flatten(), bins=256, range=(0, 256))[0]
+    # Find the histograms for all three channels. The pixels are uint8, so counting each value directly
+    # gives the same result as a 256 bin histogram
+    hist_r = np.bincount(image[:, :, 0].ravel(), minlength=256)
+    hist_g = np.bincount(image[:, :, 1].ravel(), minlength=256)
+    hist_b = np.bincount(image[:, :, 2].ravel(), minlength=256)
 
     # Create a binary representation of the shape of the object in the image
     shape = mask_color(image, (139, 139, 139))
@@ -79,10 +85,34 @@ class InventoryViewer:
     def load_invicons(self):
         # Load all inventory icons from the directory and add them to the database
         # The icons taken from the wiki are named 'Invicon_[item name].png', so we look for this pattern.
-        for filename in os.listdir(self.invicon_dir):
-            if filename.startswith('Invicon_') and filename.endswith('.png'):
-                item = self.ItemImage(os.path.join(self.invicon_dir, filename))
-                self.db.add_vector(item.as_vector(), filename)
+        filenames = sorted(filename for filename in os.listdir(self.invicon_dir)
+                           if filename.startswith('Invicon_') and filename.endswith('.png'))
+
+        # The vectors are cached on disk, keyed by the names, sizes and modification times of the icons,
+        # so that the icons are only decoded again when one of them changes
+        listing = []
+        for filename in filenames:
+            stat = os.stat(os.path.join(self.invicon_dir, filename))
+            listing.append((filename, stat.st_size, stat.st_mtime_ns))
+        key = hashlib.sha1(repr(listing).encode()).hexdigest()
+        cache_path = os.path.join(self.invicon_dir, INVICON_CACHE_FILENAME)
+
+        try:
+            with np.load(cache_path) as cache:
+                if cache['key'] == key:
+                    self.db.add_vectors(cache['vectors'], cache['values'].tolist())
+                    return
+        except (OSError, KeyError, ValueError):
+            pass
+
+        for filename in filenames:
+            item = self.ItemImage(os.path.join(self.invicon_dir, filename))
+            self.db.add_vector(item.as_vector(), filename)
+
+        try:
+            np.savez(cache_path, key=key, vectors=np.array(self.db.vectors), values=np.array(self.db.values))
+        except OSError:
+            pass
 
     def process_inventory_image(self, image_path):
         """
@@ -146,7 +176,9 @@ class InventoryViewer:
         # Then scale it back up to the original size
         empty_slot_mask = empty_slot_mask[::gui_scale, ::gui_scale]
         empty_slot_mask = remove_stray_pixels(empty_slot_mask)
-        empty_slot_mask = np.repeat(np.repeat(empty_slot_mask, gui_scale, axis=0), gui_scale, axis=1)
+        height, width = empty_slot_mask.shape
+        empty_slot_mask = cv2.resize(empty_slot_mask, (width * gui_scale, height * gui_scale),
+                                     interpolation=cv2.INTER_NEAREST)
 
         # Find the contours of the empty slots
         contours, _ = cv2.findContours(empty_slot_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
@@ -156,15 +188,14 @@ class InventoryViewer:
 
         # Find the most common width of the inventory slots
         widths = [cv2.boundingRect(contour)[2] for contour in contours]
-        width_counts = {width: widths.count(width) for width in widths}
-        most_common_width = max(width_counts, key=width_counts.get)
+        most_common_width = collections.Counter(widths).most_common(1)[0][0]
 
         # Remove any contours that don't have the most common width, since all inventory slots should have the same size
         contours = [contour for contour in contours if cv2.boundingRect(contour)[2] == most_common_width]
 
         # Create InventorySlot objects for each slot, then search for the closest item in the database
         slots = [self.InventorySlot(inventory_img, *cv2.boundingRect(contour)) for contour in contours]
-        items = [self.db.find_closest_vector(slot.as_vector()) for slot in slots if not slot.is_empty()]
+        items = self.db.find_closest_vectors([slot.as_vector() for slot in slots if not slot.is_empty()])
 
         # Return the list of items in the inventory, removing the 'Invicon_' prefix and '.png' suffix
         return [item.replace('Invicon_', '').replace('.png', '').replace('_', ' ') for item in items]
@@ -200,7 +231,12 @@ class InventoryViewer:
             if self.w != self.h or (self.w & (self.w - 1)) != 0:
                 raise ValueError('Image must be a square with a size that is a power of 2')
             self.image = self.image[::self.w // 16, ::self.h // 16]
-            self.empty = np.all(np.logical_or(self.image == (139, 139, 139), self.image == (85, 85, 85)))
+            # Check the four corners first, since they already rule out most slots with an item in them
+            self.empty = self.is_background(self.image[::15, ::15]) and self.is_background(self.image)
+
+        @staticmethod
+        def is_background(image):
+            return np.all(np.logical_or(image == (139, 139, 139), image == (85, 85, 85)))
 
         def is_empty(self):
             return self.empty
@@ -217,20 +253,39 @@ class InventoryViewer:
         def __init__(self):
             self.vectors = []
             self.values = []
+            # The vectors stacked into one matrix, along with their squared norms. These are rebuilt
+            # on the first search after a vector is added.
+            self.matrix = None
+            self.squared_norms = None
 
         def add_vector(self, vector, value):
             self.vectors.append(vector)
             self.values.append(value)
+            self.matrix = None
+
+        def add_vectors(self, vectors, values):
+            self.vectors.extend(vectors)
+            self.values.extend(values)
+            self.matrix = None
 
         def find_closest_vector(self, vector):
-            min_distance = float('inf')
-            closest_value = None
-            for i, v in enumerate(self.vectors):
-                distance = np.linalg.norm(vector - v)
-                if distance < min_distance:
-                    min_distance = distance
-                    closest_value = self.values[i]
-            return closest_value
+            return self.find_closest_vectors([vector])[0]
+
+        def find_closest_vectors(self, vectors):
+            """
+            Find the value of the closest stored vector for each of the given vectors, all at once.
+            """
+            if not self.vectors or not vectors:
+                return [None] * len(vectors)
+
+            if self.matrix is None:
+                self.matrix = np.array(self.vectors, dtype=np.float64)
+                self.squared_norms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+
+            # |v_i - vector|^2 = |v_i|^2 - 2 v_i . vector + |vector|^2, and the last term is the same for
+            # every stored vector, so the closest ones can be found with a single matrix product
+            distances = self.squared_norms - 2 * (np.array(vectors, dtype=np.float64) @ self.matrix.T)
+            return [self.values[i] for i in np.argmin(distances, axis=1)]
 
 
 if __name__ == '__main__':
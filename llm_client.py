@@ -1,7 +1,16 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import logging
+import threading
 import time
-import json
 
-from openai import OpenAI
+import orjson
+from typing import Iterator
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, OpenAI, RateLimitError
 from agent_base import Message
 
 
@@ -15,12 +24,32 @@ class MessageHistory:
     def __init__(self):
         self.history = []
         self.history_stack = []
+        # Per-agent system prompts, kept out of the shared history so that each
+        # agent's view starts with the same prefix on every call
+        self.system_prompts = {}
+        # JSON of the messages which must never change, see freeze_prefix
+        self.frozen_prefix = []
+        # String form of the first str_count messages, extended by __str__ as messages are added.
+        # Methods which change or remove existing messages reset it.
+        self.str_cache = ""
+        self.str_count = 0
+        # Merged views of the history, extended by view as messages are added. Each entry maps an
+        # agent to (epoch, number of messages merged, merged messages, contents of the last run,
+        # first ordering error after the first message). The epoch is incremented by the methods
+        # which change or remove existing messages.
+        self.view_cache = {}
+        self.epoch = 0
+        # Sent as the prompt cache key with every request for this history, so the server
+        # can route them to where its prefix is already cached. None sends no key.
+        self.cache_key = None
 
     def start_transaction(self):
         """
-        This function starts a transaction by saving the current history to a stack.
+        This function starts a transaction by saving the current length of the history to a stack.
+        Messages are only ever appended, so rolling back only needs to drop the ones after it.
+        clear_all_but_system replaces the lengths of open transactions with copies of their messages.
         """
-        self.history_stack.append(self.history.copy())
+        self.history_stack.append(len(self.history))
 
     def rollback(self):
         """
@@ -29,7 +58,14 @@ class MessageHistory:
         if not self.history_stack:
             raise ValueError("No transaction to rollback.")
 
-        self.history = self.history_stack.pop()
+        saved = self.history_stack.pop()
+        if isinstance(saved, list):
+            # Saved by clear_all_but_system
+            self.history = saved
+        else:
+            # Truncate in place instead of copying the messages which are kept
+            del self.history[saved:]
+        self.reset_caches()
 
     def commit(self):
         """
@@ -46,12 +82,54 @@ class MessageHistory:
         """
         self.history.append(Message(role, content))
 
+    def set_system_prompt(self, agent: str, content: str):
+        """
+        This function sets the system prompt of an agent. It is placed right after the
+        leading system messages in the agent's view of the history.
+        """
+        self.system_prompts[agent] = content
+
+    def copy(self) -> 'MessageHistory':
+        """
+        This function returns a copy of the history which can be changed without
+        affecting this one, e.g. to call the LLM on a snapshot from another thread.
+        """
+        history = MessageHistory()
+        history.history = self.history.copy()
+        history.system_prompts = self.system_prompts.copy()
+        history.frozen_prefix = self.frozen_prefix
+        history.cache_key = self.cache_key
+        return history
+
+    def freeze_prefix(self):
+        """
+        This function freezes the current messages. From then on, the history must only be
+        appended to (or rolled back to a point after the frozen messages). Changing or removing
+        earlier messages, e.g. to summarize them, changes the prefix of every following request,
+        so the server can no longer reuse its cache and has to process the whole prompt again.
+        """
+        self.frozen_prefix = [message.to_json() for message in self.history]
+
+    def prefix_unchanged(self) -> bool:
+        """
+        This function checks that the messages frozen with freeze_prefix are unchanged.
+        """
+        if len(self.history) < len(self.frozen_prefix):
+            return False
+
+        return all(message.to_json() == frozen for message, frozen in zip(self.history, self.frozen_prefix))
+
     def clear_all_but_system(self):
         """
         Clears all messages except the system message
         """
         if len(self.history) > 1:
-            self.history = [self.history[0]]
+            # Open transactions only saved the length to roll back to, which doesn't
+            # restore the removed messages, so they save copies of the messages instead
+            self.history_stack = [self.history[:saved] if isinstance(saved, int) else saved
+                                  for saved in self.history_stack]
+            del self.history[1:]
+            self.reset_caches()
 
     def view(self, agent: str) -> list[Message]:
         """
@@ -64,46 +142,67 @@ class MessageHistory:
             Other agents' messages will be renamed to "user". System messages of
             the form "system_<agent>" will be renamed to "system" with the other
             agents' system messages removed. "system" messages will be kept as is.
+            The agent's system prompt set with set_system_prompt is added after
+            the leading system messages.
         """
 
         if not self.history:
             raise ValueError("Message history is empty.")
 
-        # Rename all messages where the role matches the agent to "assistant"
-        # since "assistant" represents the responses of the agent in the API.
-        # Also, remove the system messages for other agents.
-        if agent:
-            renamed_history = MessageHistory()
-
-            for message in self.history:
-                if message.role == agent:
-                    renamed_history.add("assistant", message.content)
-                elif message.role == "system" or message.role == "system_" + agent:
-                    renamed_history.add("system", message.content)
-                elif not message.role.startswith("system_"):
-                    new_content = message.role.upper() + ": " + message.content
-                    renamed_history.add("user", new_content)
-
-            renamed_history = renamed_history.history
-        else:
-            renamed_history = self.history.copy()
-
-        new_history = []
-        current_new_message = Message("", "")
+        # Only the messages added since the last call are renamed and merged
+        epoch, count, merged, last_parts, ordering_error = self.view_cache.get(agent, (None, 0, None, None, None))
+        if epoch != self.epoch or count > len(self.history):
+            count, merged, last_parts, ordering_error = 0, [], [], None
 
-        # Merge repeated user and assistant messages with \n as separator
-        for message in renamed_history:
-            if not agent and message.role not in ["system", "user", "assistant"]:
-                raise ValueError("Invalid role in message. Pass in agent to merge messages.")
-
-            if message.role == current_new_message.role:
-                current_new_message.content += "\n" + message.content
+        # Whether the last merged message is missing some of the contents of its run
+        stale = False
+        try:
+            for message in self.history[count:]:
+                role, content = self._rename(message, agent)
+                if role is None:
+                    continue
+
+                # Merge repeated user and assistant messages with \n as separator. The contents
+                # of a run are collected and joined once, when the run ends or after the loop.
+                if merged and merged[-1].role == role:
+                    last_parts.append(content)
+                    stale = True
+                else:
+                    if stale:
+                        merged[-1] = Message(merged[-1].role, "\n".join(last_parts))
+                        stale = False
+                    # The ordering is checked once per merged message as it is added, rather
+                    # than over the whole view on every call
+                    if merged and ordering_error is None:
+                        ordering_error = self._ordering_error(len(merged), role)
+                    merged.append(Message(role, content))
+                    last_parts = [content]
+        except ValueError:
+            self.view_cache.pop(agent, None)
+            raise
+
+        if stale:
+            merged[-1] = Message(merged[-1].role, "\n".join(last_parts))
+
+        self.view_cache[agent] = (self.epoch, len(self.history), merged, last_parts, ordering_error)
+
+        new_history = merged.copy()
+
+        # Keep the static content first so that only the tail of the prompt
+        # changes between calls, which lets the server reuse its prompt cache
+        if agent and agent in self.system_prompts:
+            system_prompt = self.system_prompts[agent]
+            if new_history and new_history[0].role == "system":
+                new_history[0] = Message("system", new_history[0].content + "\n" + system_prompt)
             else:
-                if current_new_message.role:
-                    new_history.append(current_new_message)
-                current_new_message = message.copy()
+                new_history.insert(0, Message("system", system_prompt))
+                # The merged messages moved by one, so the cached check doesn't apply
+                ordering_error = None
+                for i in range(1, len(new_history)):
+                    ordering_error = ordering_error or self._ordering_error(i, new_history[i].role)
 
-        new_history.append(current_new_message)
+        if not new_history:
+            raise ValueError("First message must be a system message.")
 
         if not new_history[0].role == "system":
             raise ValueError("First message must be a system message.")
@@ -111,14 +210,46 @@ class MessageHistory:
         if not new_history[-1].role == "user":
             raise ValueError("Last message must be a user message.")
 
-        for i in range(1, len(new_history) - 1):
-            if i % 2 == 1 and new_history[i].role != "user":
-                raise ValueError("Incorrect ordering: User message expected.")
-            elif i % 2 == 0 and new_history[i].role != "assistant":
-                raise ValueError("Incorrect ordering: Assistant message expected.")
+        if ordering_error:
+            raise ValueError(ordering_error)
 
         return new_history
 
+    @staticmethod
+    def _ordering_error(i: int, role: str) -> str | None:
+        """
+        This function checks the role of the message at index i of a view, after the
+        first (system) message, and returns the error if it is out of order.
+        """
+        if i % 2 == 1 and role != "user":
+            return "Incorrect ordering: User message expected."
+        elif i % 2 == 0 and role != "assistant":
+            return "Incorrect ordering: Assistant message expected."
+        return None
+
+    @staticmethod
+    def _rename(message: Message, agent: str | None) -> tuple[str | None, str]:
+        """
+        This function returns the role and content of a message from the perspective of the
+        agent, see view. The role is None if the agent must not see the message.
+        """
+        # Rename all messages where the role matches the agent to "assistant"
+        # since "assistant" represents the responses of the agent in the API.
+        # Also, remove the system messages for other agents.
+        if not agent:
+            if message.role not in ["system", "user", "assistant"]:
+                raise ValueError("Invalid role in message. Pass in agent to merge messages.")
+            return message.role, message.content
+
+        if message.role == agent:
+            return "assistant", message.content
+        elif message.role == "system" or message.role == "system_" + agent:
+            return "system", message.content
+        elif not message.role.startswith("system_"):
+            return "user", message.role.upper() + ": " + message.content
+
+        return None, message.content
+
     def to_api_format(self, agent=None) -> list[dict]:
         """
         This function returns the JSON-like representation of the message history.
@@ -143,10 +274,17 @@ class MessageHistory:
         """
 
         try:
-            json_message = json.loads(json_message_str)
-        except json.JSONDecodeError:
+            json_message = orjson.loads(json_message_str)
+        except orjson.JSONDecodeError:
             raise ValueError("Invalid JSON format.")
 
+        self.add_from_dict(json_message)
+
+    def add_from_dict(self, json_message: dict):
+        """
+        This function appends messages from an already parsed API response to the history.
+        """
+
         if "choices" not in json_message or len(json_message["choices"]) == 0:
             raise ValueError("JSON message must contain 'choices' with at least one valid message.")
 
@@ -184,9 +322,50 @@ class MessageHistory:
             raise ValueError("Message history is empty.")
 
         self.history[-1].role = role
+        self.reset_caches()
+
+    def reset_caches(self):
+        self.str_cache = ""
+        self.str_count = 0
+        self.view_cache.clear()
+        self.epoch += 1
 
     def __str__(self):
-        return "\n".join([str(message) for message in self.history])
+        if len(self.history) < self.str_count:
+            self.reset_caches()
+
+        # Only the messages added since the last call need to be formatted
+        new_lines = [str(message) for message in self.history[self.str_count:]]
+        if new_lines:
+            if self.str_count:
+                new_lines.insert(0, self.str_cache)
+            self.str_cache = "\n".join(new_lines)
+            self.str_count = len(self.history)
+
+        return self.str_cache
+
+
+# Shared by all clients so that requests from different agents can be in flight at
+# the same time, which lets the server batch them
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="llm")
+
+# Errors which mean that the server is unavailable, rather than that the request is wrong
+_TRANSIENT_ERRORS = (APIConnectionError, RateLimitError, InternalServerError)
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    Raised instead of making a request while the server is considered unavailable, see
+    LLMClient. Callers should try again after retry_after seconds.
+    """
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"circuit open, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+# Errors after which the same request can succeed later, e.g. once the server is back up
+UNAVAILABLE_ERRORS = (CircuitOpenError,) + _TRANSIENT_ERRORS
 
 
 class LLMClient:
@@ -195,29 +374,381 @@ class LLMClient:
 
     :param url: The URL of the LLM API
     :param model: The model name to call for in the LLM API
+    :param http_client: An HTTP client (e.g. openai.DefaultHttpxClient) to share its
+        connection pool with other clients talking to the same server
+    :param async_http_client: The same for the async methods (e.g. openai.DefaultAsyncHttpxClient)
+    :param max_retries: How many times the OpenAI client retries a failed request, with
+        exponential backoff and jitter
+    :param circuit_threshold: After this many consecutive requests failed because the server
+        was unavailable, further requests fail immediately...
+    :param circuit_cooldown: ...for this many seconds
     """
 
-    def __init__(self, url: str, model: str):
+    def __init__(self, url: str, model: str, http_client=None, async_http_client=None,
+                 max_retries: int = 5, circuit_threshold: int = 5, circuit_cooldown: float = 30.0):
         self.url = url
         self.model = model
-        self.client = OpenAI(base_url=url, max_retries=100)
+        self.client = OpenAI(base_url=url, max_retries=max_retries, http_client=http_client)
+        # Used by ainvoke, its connections belong to the event loop which first uses it
+        self.async_client = AsyncOpenAI(base_url=url, max_retries=max_retries, http_client=async_http_client)
+
+        self.circuit_threshold = circuit_threshold
+        self.circuit_cooldown = circuit_cooldown
+        self.failures = 0
+        self.circuit_open_until = 0.0
+        # Whether the single request let through after the cooldown is still running
+        self.circuit_probing = False
+        self.circuit_lock = threading.Lock()
+
+    def warm_up(self):
+        """
+        This function opens a connection to the LLM API in the background, so that the
+        first real call doesn't have to wait for it. Errors are only logged, the first
+        call will report them if the server is really unavailable.
+        """
+        def connect():
+            try:
+                self.client.with_options(max_retries=0).models.list()
+            except Exception as e:
+                logging.debug(f"Connection warm up failed: {e}")
 
-    def invoke(self, message_history: MessageHistory, agent=None, max_tokens=1024) -> MessageHistory:
+        threading.Thread(target=connect, daemon=True, name="llm-warm-up").start()
+
+    @contextlib.contextmanager
+    def _circuit(self):
+        """
+        This context manager wraps a request to the LLM API. While the circuit is open, it
+        raises a CircuitOpenError without making the request, so callers fail fast instead of
+        waiting for retries against a server which is down. After the cooldown, a single
+        request is let through as a probe. If it succeeds the circuit closes, if the server
+        is still unavailable the circuit opens again.
+        """
+        probe = False
+        with self.circuit_lock:
+            if self.failures >= self.circuit_threshold:
+                remaining = self.circuit_open_until - time.monotonic()
+                if remaining > 0:
+                    raise CircuitOpenError(remaining)
+                if self.circuit_probing:
+                    # The probe decides, which takes about as long as a request
+                    raise CircuitOpenError(1.0)
+                self.circuit_probing = probe = True
+
+        try:
+            yield
+        except _TRANSIENT_ERRORS:
+            with self.circuit_lock:
+                self.failures += 1
+                if self.failures >= self.circuit_threshold:
+                    self.circuit_open_until = time.monotonic() + self.circuit_cooldown
+            raise
+        else:
+            with self.circuit_lock:
+                self.failures = 0
+        finally:
+            if probe:
+                with self.circuit_lock:
+                    self.circuit_probing = False
+
+    def invoke(self, message_history: MessageHistory, agent=None, max_tokens=1024,
+               temperature: float | None = None, stop: list[str] | None = None,
+               role: str = "assistant") -> MessageHistory:
         """
         This function calls the LLM API with the given message history and returns
-        the updated message history, with the LLM's response appended to it.
+        the updated message history, with the LLM's response appended to it under the role.
+        If temperature is None, the server's default temperature is used. Generation
+        ends at any of the stop strings, which are not included in the response.
+        Agents sharing a history pass their own name as the role, which keeps the
+        history's cached views valid, unlike changing the role afterwards.
+        """
+        assert message_history.prefix_unchanged(), "The frozen prefix of the message history was changed."
+
+        content = self._complete(message_history.to_api_format(agent), max_tokens, temperature, stop,
+                                 message_history.cache_key)
+        message_history.add(role, content)
+        return message_history
+
+    def invoke_async(self, message_history: MessageHistory, agent=None, max_tokens=1024,
+                     temperature: float | None = None, stop: list[str] | None = None) -> concurrent.futures.Future:
         """
+        This function starts an invoke call in the background and returns a Future for the
+        updated message history. The message history must not be changed until it is done.
+        """
+        return _executor.submit(self.invoke, message_history, agent, max_tokens, temperature, stop)
 
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=message_history.to_api_format(agent),
-            max_tokens=max_tokens,
-        )
+    def batch_invoke(self, message_histories: list[MessageHistory], agent=None, max_tokens=1024,
+                     temperature: float | None = None, stop: list[str] | None = None,
+                     max_concurrency: int = 16, rpm_limit: int | None = None) -> list[MessageHistory]:
+        """
+        This function invokes the LLM on several independent message histories at the same
+        time and returns them, updated, in the same order. At most max_concurrency requests
+        are in flight at once, and if rpm_limit is set, requests are started at most that
+        many times per minute.
+        """
+        if not message_histories:
+            return []
+
+        lock = threading.Lock()
+        next_start = time.monotonic()
+
+        def invoke(message_history: MessageHistory) -> MessageHistory:
+            nonlocal next_start
+            if rpm_limit:
+                # Each request reserves the next free start time, spaced evenly over the minute
+                with lock:
+                    start = max(next_start, time.monotonic())
+                    next_start = start + 60 / rpm_limit
+                time.sleep(max(0.0, start - time.monotonic()))
+
+            return self.invoke(message_history, agent, max_tokens, temperature, stop)
+
+        max_workers = min(max_concurrency, len(message_histories))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-batch") as executor:
+            return list(executor.map(invoke, message_histories))
+
+    async def ainvoke(self, message_history: MessageHistory, agent=None, max_tokens=1024,
+                      temperature: float | None = None, stop: list[str] | None = None,
+                      role: str = "assistant") -> MessageHistory:
+        """
+        This function is the asyncio version of invoke. Many calls can be awaited at the
+        same time from a single thread, see ainvoke_many.
+        """
+        assert message_history.prefix_unchanged(), "The frozen prefix of the message history was changed."
 
-        content = response.choices[0].message.content
-        message_history.add("assistant", content)
+        content = await self._acomplete(message_history.to_api_format(agent), max_tokens, temperature, stop,
+                                        message_history.cache_key)
+        message_history.add(role, content)
         return message_history
 
+    async def ainvoke_many(self, message_histories: list[MessageHistory], agent=None, max_tokens=1024,
+                           temperature: float | None = None,
+                           stop: list[str] | None = None) -> list[MessageHistory]:
+        """
+        This function invokes the LLM on several independent message histories concurrently
+        and returns them, updated, in the same order.
+        """
+        return await asyncio.gather(*(
+            self.ainvoke(message_history, agent, max_tokens, temperature, stop)
+            for message_history in message_histories
+        ))
+
+    def stream_invoke(self, message_history: MessageHistory, agent=None, max_tokens=1024,
+                      temperature: float | None = None, stop: list[str] | None = None) -> Iterator[str]:
+        """
+        This function calls the LLM API with the given message history and yields the
+        response in chunks as it is generated. The message history is not updated.
+        Stopping the iteration early closes the connection, which ends the generation.
+        """
+        assert message_history.prefix_unchanged(), "The frozen prefix of the message history was changed."
+
+        with self._circuit():
+            stream = self.client.chat.completions.create(
+                model=self.model,
+                messages=message_history.to_api_format(agent),
+                max_tokens=max_tokens,
+                stream=True,
+                **self._options(temperature, stop, message_history.cache_key),
+            )
+
+        try:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            stream.close()
+
+    @staticmethod
+    def _options(temperature: float | None, stop: list[str] | None, cache_key: str | None = None) -> dict:
+        # Only send the options which are set so the server defaults apply otherwise
+        options = {}
+        if temperature is not None:
+            options["temperature"] = temperature
+        if stop:
+            options["stop"] = stop
+        if cache_key is not None:
+            # In the body rather than as a keyword, which older SDK versions reject
+            options["extra_body"] = {"prompt_cache_key": cache_key}
+        return options
+
+    def _complete(self, messages: list[dict], max_tokens: int, temperature: float | None,
+                  stop: list[str] | None, cache_key: str | None = None) -> str:
+        """
+        This function calls the LLM API with messages in the API format and returns the response.
+        """
+        with self._circuit():
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=max_tokens,
+                **self._options(temperature, stop, cache_key),
+            )
+
+        return response.choices[0].message.content
+
+    async def _acomplete(self, messages: list[dict], max_tokens: int, temperature: float | None,
+                         stop: list[str] | None, cache_key: str | None = None) -> str:
+        with self._circuit():
+            response = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=max_tokens,
+                **self._options(temperature, stop, cache_key),
+            )
+
+        return response.choices[0].message.content
+
+
+class CachedLLMClient(LLMClient):
+    """
+    This class is an LLMClient which remembers the responses to its most recent requests
+    and returns them without calling the LLM API when exactly the same request is made again.
+
+    Only deterministic requests (temperature 0) are cached, sampled responses are
+    expected to differ between calls. Streamed requests are not cached.
+
+    :param url: The URL of the LLM API
+    :param model: The model name to call for in the LLM API
+    :param max_size: The maximum number of responses to remember
+    :param http_client: An HTTP client to share with other clients, see LLMClient
+    :param async_http_client: An async HTTP client to share with other clients, see LLMClient
+    """
+
+    def __init__(self, url: str, model: str, max_size: int = 256, http_client=None,
+                 async_http_client=None):
+        super().__init__(url, model, http_client=http_client, async_http_client=async_http_client)
+        self.max_size = max_size
+        self.cache = collections.OrderedDict()
+        # Agents share clients across threads
+        self.cache_lock = threading.Lock()
+
+    def _cache_key(self, messages: list[dict], max_tokens: int, temperature: float | None,
+                   stop: list[str] | None) -> str:
+        request = orjson.dumps([self.model, messages, max_tokens, temperature, stop])
+        return hashlib.blake2b(request, digest_size=16).hexdigest()
+
+    def _cache_get(self, key: str) -> str | None:
+        with self.cache_lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        return None
+
+    def _cache_put(self, key: str, content: str):
+        with self.cache_lock:
+            self.cache[key] = content
+            self.cache.move_to_end(key)
+            if len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def _complete(self, messages: list[dict], max_tokens: int, temperature: float | None,
+                  stop: list[str] | None, cache_key: str | None = None) -> str:
+        if temperature != 0:
+            return super()._complete(messages, max_tokens, temperature, stop, cache_key)
+
+        key = self._cache_key(messages, max_tokens, temperature, stop)
+        content = self._cache_get(key)
+        if content is None:
+            content = super()._complete(messages, max_tokens, temperature, stop, cache_key)
+            self._cache_put(key, content)
+
+        return content
+
+    async def _acomplete(self, messages: list[dict], max_tokens: int, temperature: float | None,
+                         stop: list[str] | None, cache_key: str | None = None) -> str:
+        if temperature != 0:
+            return await super()._acomplete(messages, max_tokens, temperature, stop, cache_key)
+
+        key = self._cache_key(messages, max_tokens, temperature, stop)
+        content = self._cache_get(key)
+        if content is None:
+            content = await super()._acomplete(messages, max_tokens, temperature, stop, cache_key)
+            self._cache_put(key, content)
+
+        return content
+
+
+@functools.cache
+def _load_sentence_encoder(model_name: str):
+    # Loaded once and shared by all semantic caches
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(model_name)
+
+
+class SemanticCache:
+    """
+    This class remembers LLM responses by the meaning of their prompts. A response is
+    returned for a new prompt if it is similar enough to a prompt seen before, even
+    if the wording differs.
+
+    Only use it for repetitive prompts where an earlier answer is still a good answer,
+    e.g. scoring or simple questions, not for planning.
+
+    It requires faiss and sentence-transformers. If they are not installed, the cache
+    is disabled and never returns a response.
+
+    :param threshold: Minimum cosine similarity between prompts for a cache hit
+    :param max_size: The maximum number of responses to remember before starting over
+    :param model_name: The sentence-transformers model used to embed the prompts
+    """
+
+    def __init__(self, threshold: float = 0.92, max_size: int = 1024,
+                 model_name: str = "sentence-transformers/all-MiniLM-L6-v2"):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.responses = []
+        self.lock = threading.Lock()
+
+        try:
+            import faiss
+
+            self.encoder = _load_sentence_encoder(model_name)
+        except ImportError as e:
+            logging.warning(f"Semantic cache disabled: {e}")
+            self.encoder = None
+            self.index = None
+            return
+
+        # Inner product on normalized vectors is the cosine similarity
+        self.index = faiss.IndexFlatIP(self.encoder.get_sentence_embedding_dimension())
+
+    def _embed(self, prompt: str):
+        return self.encoder.encode([prompt], normalize_embeddings=True).astype("float32")
+
+    def get(self, prompt: str) -> str | None:
+        """
+        This function returns the response to the most similar cached prompt, or None
+        if no cached prompt is similar enough.
+        """
+        if self.index is None or self.index.ntotal == 0:
+            return None
+
+        embedding = self._embed(prompt)
+
+        with self.lock:
+            scores, ids = self.index.search(embedding, 1)
+            if scores[0][0] < self.threshold:
+                return None
+            return self.responses[ids[0][0]]
+
+    def put(self, prompt: str, response: str):
+        """
+        This function adds the response to a prompt to the cache.
+        """
+        if self.index is None:
+            return
+
+        embedding = self._embed(prompt)
+
+        with self.lock:
+            # A flat index can't evict single entries, so start over once full
+            if self.index.ntotal >= self.max_size:
+                self.index.reset()
+                self.responses.clear()
+
+            self.index.add(embedding)
+            self.responses.append(response)
+
 
 def main():
     # noinspection PyUnresolvedReferences
@@ -234,17 +765,28 @@ def main():
     )
 
     while True:
+        # Reconnect while the user is typing, the connection may have been closed in the meantime
+        llm_client.warm_up()
         message = input("USER: ")
         history.add("user", "USER: " + message + "\nRead the question again: USER: " + message)
 
+        # Print the response as it is generated instead of waiting for all of it
         start = time.time_ns()
-        history = llm_client.invoke(history)
+        first_token = None
+        chunks = []
+        print("ASSISTANT: ", end="", flush=True)
+        for chunk in llm_client.stream_invoke(history):
+            if first_token is None:
+                first_token = time.time_ns()
+            chunks.append(chunk)
+            print(chunk, end="", flush=True)
         end = time.time_ns()
-        print(f"Assistant response time: {(end - start) / 1e6:.2f} ms")
+        print()
 
-        role = history.last_role()
-        msg = history.last()
-        print(f"{role.upper()}: {msg}")
+        history.add("assistant", "".join(chunks))
+        if first_token is not None:
+            print(f"Assistant time to first token: {(first_token - start) / 1e6:.2f} ms")
+        print(f"Assistant response time: {(end - start) / 1e6:.2f} ms")
 
 
 if __name__ == "__main__":
@@ -6,33 +6,68 @@ class LLMGraph:
         self.nodes = {}
         self.edges = {}
         self.conditional_edges = {}
+        # For each node, a function of the state which returns the next node and its function.
+        # Built by compile, and reset whenever the graph changes.
+        self.steps = None
 
     def add_node(self, name, func):
         self.nodes[name] = func
+        self.steps = None
 
     def add_edge(self, from_node, to_node):
         if from_node not in self.edges:
             self.edges[from_node] = []
         self.edges[from_node].append(to_node)
+        self.steps = None
 
     def add_conditional_edge(self, from_node, condition_func, condition_map):
         self.conditional_edges[from_node] = (condition_func, condition_map)
+        self.steps = None
+
+    def compile(self):
+        """
+        Resolve the outgoing edges and the functions of the nodes once, so that each step of
+        stream only takes a single lookup. Called by stream when the graph has changed.
+        """
+        names = {self.START, *self.nodes, *self.edges, *self.conditional_edges}
+        for to_nodes in self.edges.values():
+            names.update(to_nodes)
+        for _, condition_map in self.conditional_edges.values():
+            names.update(condition_map.values())
+        names.discard(self.END)
+
+        self.steps = {}
+        for name in names:
+            if name in self.conditional_edges:
+                condition_func, condition_map = self.conditional_edges[name]
+                self.steps[name] = self._conditional_step(condition_func, condition_map)
+            else:
+                next_nodes = self.edges.get(name, [self.END])
+                next_node = next_nodes[0] if next_nodes else self.END
+                self.steps[name] = self._fixed_step(next_node)
+
+    def _fixed_step(self, next_node):
+        result = (next_node, self.nodes.get(next_node))
+        return lambda state: result
+
+    def _conditional_step(self, condition_func, condition_map):
+        results = {key: (node, self.nodes.get(node)) for key, node in condition_map.items()}
+        end = (self.END, None)
+        return lambda state: results.get(condition_func(state), end)
 
     def stream(self, initial_state):
+        if self.steps is None:
+            self.compile()
+
+        steps = self.steps
         current_node = "START"
         state = initial_state
 
         while current_node != "END":
-            if current_node in self.conditional_edges:
-                condition_func, condition_map = self.conditional_edges[current_node]
-                next_node_key = condition_func(state)
-                current_node = condition_map.get(next_node_key, "END")
-            else:
-                next_nodes = self.edges.get(current_node, ["END"])
-                current_node = next_nodes[0] if next_nodes else "END"
+            current_node, func = steps[current_node](state)
 
-            if current_node in self.nodes:
-                state = self.nodes[current_node](state)
+            if func is not None:
+                state = func(state)
                 yield state
 
         # yield state
@@ -1,7 +1,22 @@
 import re
 import ast
+import functools
 import inspect
-from typing import Callable, List, Tuple, Any
+from typing import Callable, Collection, Iterator, List, Optional, Tuple, Any
+
+# A python function call, e.g. move_forward(5). The search for calls in a message stops at the
+# end of the line, while the extraction allows the arguments to span several lines.
+_TOOL_CALL_RE = re.compile(r"\w+?\(.*?\)")
+_TOOL_CALL_DOTALL_RE = re.compile(r"\w+?\(.*?\)", re.DOTALL)
+
+# The name of a python function call up to its opening parenthesis
+_CALL_START_RE = re.compile(r"([A-Za-z_]\w*)\(")
+
+# Characters after which a quote starts a string literal, rather than being an apostrophe
+_STRING_START_AFTER = frozenset("(,=[{:")
+
+# Argument names and their values, e.g. distance=5
+_ARGUMENT_NAME_RE = re.compile(r'(\w+)\s*=\s*("[^"]*"|\'[^\']*\'|\d+|[\w.]+)')
 
 
 # Custom class to wrap tool functions
@@ -44,41 +59,101 @@ def tools_to_dict(tools: List[Tool]) -> dict:
     return {tool.name: tool for tool in tools}
 
 
-def remove_argument_names(func_call: str) -> str:
-    # Regular expression to match argument names and their values
-    pattern = re.compile(r'(\w+)\s*=\s*("[^"]*"|\'[^\']*\'|\d+|[\w.]+)')
+# The tool names and the tools by name, built once per set of tools
+@functools.lru_cache(maxsize=8)
+def tools_index(tools: Tuple[Tool, ...]) -> Tuple[frozenset, dict]:
+    return frozenset(tool.name for tool in tools), tools_to_dict(tools)
+
 
+def remove_argument_names(func_call: str) -> str:
     # Replace the argument names with just their values
-    result = pattern.sub(r'\2', func_call)
+    result = _ARGUMENT_NAME_RE.sub(r'\2', func_call)
 
     return result
 
 
+def find_call_end(text: str, start: int) -> int:
+    """
+    Return the index just after the ")" which closes the "(" at text[start], or -1 if it
+    isn't closed (yet). Parentheses inside string literals, e.g. look_at('oak log (left)'),
+    don't count. A quote only starts a string at the start of an argument, so apostrophes
+    in unquoted arguments, e.g. visual_question(What's there?), don't either.
+    """
+    depth = 0
+    quote = None
+    previous = ""
+    for i in range(start, len(text)):
+        char = text[i]
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char in "'\"" and previous in _STRING_START_AFTER:
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        if not char.isspace():
+            previous = char
+    return -1
+
+
+def is_tool_call_complete(text: str) -> bool:
+    """
+    Whether the first function call in the text is closed, used to stop generating a
+    response once its tool call is complete.
+    """
+    match = _CALL_START_RE.search(text)
+    return match is not None and find_call_end(text, match.end() - 1) != -1
+
+
 # Function to parse Python code
 def parse_python_code(
-        code: str, valid_functions: List[str]
+        code: str, valid_functions: Collection[str]
 ) -> List[Tuple[str, Tuple[Any, ...]]]:
-    # TODO: This really isn't ideal or generalizable.
-    code = remove_argument_names(code)
+    return list(iter_calls(code, valid_functions))
 
-    tree = ast.parse(code)
-    parsed_calls = []
 
-    for node in ast.walk(tree):
-        if isinstance(node, ast.Call):
-            func_name = node.func.id if isinstance(node.func, ast.Name) else None
-            if func_name in valid_functions:
-                args = []
-                for arg in node.args:
-                    if isinstance(arg, ast.Constant):  # For Python 3.8+
-                        args.append(arg.value)
-                    elif isinstance(arg, ast.Str):  # For Python 3.7 and below
-                        args.append(arg.s)
-                    elif isinstance(arg, ast.Num):  # For Python 3.7 and below
-                        args.append(arg.n)
-                parsed_calls.append((func_name, tuple(args)))
+# Function to parse only the first valid call in Python code
+def parse_first_call(
+        code: str, valid_functions: Collection[str]
+) -> Optional[Tuple[str, Tuple[Any, ...]]]:
+    return next(iter_calls(code, valid_functions), None)
 
-    return parsed_calls
+
+def iter_calls(
+        code: str, valid_functions: Collection[str]
+) -> Iterator[Tuple[str, Tuple[Any, ...]]]:
+    # TODO: This really isn't ideal or generalizable.
+    # Most calls have no keyword arguments, which is much faster to check than with the regex
+    if "=" in code:
+        code = remove_argument_names(code)
+
+    # The tools only take literal positional arguments, so the calls are found with a regex
+    # and a scan for their closing parenthesis, and only their arguments are evaluated,
+    # instead of parsing the code as python
+    pos = 0
+    while (match := _CALL_START_RE.search(code, pos)) is not None:
+        end = find_call_end(code, match.end() - 1)
+        if end == -1:
+            # Unbalanced, the arguments end at the first ")" instead
+            end = code.find(")", match.end()) + 1
+            if end == 0:
+                return
+        # Calls nested in the arguments are not calls to run
+        pos = end
+
+        func_name = match.group(1)
+        if func_name in valid_functions:
+            args_src = code[match.end():end - 1].strip()
+            try:
+                args = ast.literal_eval(f"({args_src},)") if args_src else ()
+            except (ValueError, SyntaxError):
+                # Leave out arguments which aren't literals, the call is then reported as invalid
+                args = ()
+            yield func_name, tuple(args)
 
 
 # Function to verify function call matches the signature
@@ -95,54 +170,72 @@ def execute_function_call(tool: Tool, args: Tuple[Any, ...]) -> Any:
     return tool(*args)
 
 
+# Only the first call is executed, since the result of each action has to be seen before the next one
 def execute_tools(
         parsed_code: List[Tuple[str, Tuple[Any, ...]]], tools_dict: dict
 ) -> str:
-    outputs = []
-
-    for func_name, args in parsed_code:
-        if func_name in tools_dict:
-            tool = tools_dict[func_name]
-            if verify_function_call(tool, args):
-                result = str(execute_function_call(tool, args))
-                outputs.append(f"{func_name}{args} -> {result}")
-            else:
-                outputs.append(f"Invalid arguments for function {func_name}: {args}")
-                # raise TypeError(f"Invalid arguments for function {func_name}: {args}")
+    if not parsed_code:
+        return ""
+
+    return execute_tool_call(parsed_code[0], tools_dict)
+
+
+def execute_tool_call(call: Tuple[str, Tuple[Any, ...]], tools_dict: dict) -> str:
+    func_name, args = call
+    if func_name in tools_dict:
+        tool = tools_dict[func_name]
+        if verify_function_call(tool, args):
+            result = str(execute_function_call(tool, args))
+            return f"{func_name}{args} -> {result}"
         else:
-            outputs.append(f"Function {func_name} is not a valid tool")
-            # raise NameError(f"Function {func_name} is not a valid tool")
+            return f"Invalid arguments for function {func_name}: {args}"
+            # raise TypeError(f"Invalid arguments for function {func_name}: {args}")
+    else:
+        return f"Function {func_name} is not a valid tool"
+        # raise NameError(f"Function {func_name} is not a valid tool")
 
-        break
 
-    return "\n".join(outputs)
+# Routing checks a message with are_tools_present and then runs its tools with extract_and_run_tools,
+# so the search for the first call is cached to scan each message only once
+@functools.lru_cache(maxsize=16)
+def first_tool_call(message: str) -> Optional[re.Match]:
+    return _TOOL_CALL_DOTALL_RE.search(message)
 
 
 def are_tools_present(message: str) -> bool:
     # Check if the message contains a python function call.
-    return bool(re.search(r"\w+?\(.*?\)", message))
-
+    # Most messages have no parentheses at all, which is much faster to rule out than with the regex
+    if "(" not in message or ")" not in message:
+        return False
 
-def extract_and_run_tools(message: str, tools: List[Tool]) -> str:
-    # Extract and run the tools from the message
-    code_blocks = re.findall(r"\w+?\(.*?\)", message, re.DOTALL)
+    # A call on a single line is also found when calls can span lines, so the cached search
+    # settles most messages. Only if its first call spans lines does the message need a new search.
+    match = first_tool_call(message)
+    if match is None:
+        return False
+    if "\n" not in match.group():
+        return True
+    return _TOOL_CALL_RE.search(message) is not None
 
-    # List of valid tool function names
-    valid_functions = [tool.name for tool in tools]
 
-    tool_results = []
+def extract_and_run_tools(message: str, tools: List[Tool]) -> str:
+    # Extract and run the first tool from the message, the rest of the message is not parsed
+    code_block = first_tool_call(message)
 
-    if not code_blocks:
+    if not code_block:
         return "No tools found in the message."
 
-    # for code in code_blocks:
-    code = code_blocks[0]
-    parsed_code = parse_python_code(code, valid_functions)
-    tools_dict = tools_to_dict(tools)
-    result = execute_tools(parsed_code, tools_dict)
-    tool_results.append(result)
+    # Set of valid tool function names
+    valid_functions, tools_dict = tools_index(tuple(tools))
+
+    # The search stops at the first ")", which may be inside a string argument
+    end = find_call_end(message, message.index("(", code_block.start()))
+    call = parse_first_call(message[code_block.start():end if end != -1 else code_block.end()],
+                            valid_functions)
+    if call is None:
+        return ""
 
-    return "\n".join(tool_results)
+    return execute_tool_call(call, tools_dict)
 
 
 def main():
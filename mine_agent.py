@@ -27,7 +27,7 @@ headers = {"Content-Type": "application/json"}
 
 def call_controller_api(endpoint: str, payload: dict) -> dict:
     response = requests.post(
-        f"{controls_base_url}/{endpoint}", headers=headers, data=json.dumps(payload)
+        f"{controls_base_url}/{endpoint}", headers=headers, json=payload
     )
 
     assert response.status_code == 200, f"Error: {response.text}"
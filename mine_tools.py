@@ -4,8 +4,12 @@ from llm_tools import (
     tool,
     tools_to_string,
 )
+import functools
 import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 # --------------------- Tools ---------------------
@@ -133,8 +137,10 @@ def done() -> str:
 
 # --------------------- Infrastructure ---------------------
 
+# The tools never change, so build the tuple and the prompt string once
+@functools.cache
 def get_tools():
-    tools = [
+    tools = (
         look_at,
         move_forward,
         mine_block,
@@ -146,11 +152,12 @@ def get_tools():
         place_block,
         craft_item,
         turn,
-    ]
+    )
 
     return tools
 
 
+@functools.cache
 def get_tools_string():
     return tools_to_string(get_tools())
 
@@ -177,10 +184,27 @@ except FileNotFoundError:
     raise FileNotFoundError(exception_message)
 
 
+# Reuse the connections to the controls API instead of opening a new one per tool call.
+# The pool is sized to match the threads of the controls API server. Only failed connections
+# are retried, since retrying a request that reached the server would repeat the action.
+session = requests.Session()
+retries = Retry(total=3, connect=3, read=0, status=0, backoff_factor=0.2)
+session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retries))
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retries))
+
+# (connect, read) timeouts in seconds. Some actions, e.g. mining, take a while to complete.
+CONTROLLER_TIMEOUT = (10, 60)
+
+
+def close_session():
+    session.close()
+
+
 def call_controller_api(endpoint: str, payload: dict) -> str:
-    response = requests.post(
-        f"{controls_base_url}/{endpoint}", headers=headers, data=json.dumps(payload)
+    response = session.post(
+        f"{controls_base_url}/{endpoint}", headers=headers, json=payload,
+        timeout=CONTROLLER_TIMEOUT
     )
 
     assert response.status_code == 200, f"Error: {response.text}"
-    return response.json()["result"]
+    return orjson.loads(response.content)["result"]
@@ -1,20 +1,43 @@
-import time
+import asyncio
 import logging
-from agent_base import ThreadedAgent, MessageBus, Message
-from llm_client import LLMClient, MessageHistory
+from agent_base import AsyncAgent, MessageBus, Message
+from llm_client import UNAVAILABLE_ERRORS, CircuitOpenError, LLMClient, MessageHistory
 import mine_tools
 
 logging.basicConfig(level=logging.INFO)
 
+# Seconds to wait before retrying a request that failed because the LLM server was unavailable
+LLM_RETRY_DELAY = 5.0
 
-class MotorControlAgent(ThreadedAgent):
+
+async def ainvoke_until_available(agent: AsyncAgent, history: MessageHistory) -> MessageHistory:
+    """
+    Call agent.llm.ainvoke, retrying while the LLM server is unavailable, so that a short
+    outage doesn't end the agent. A failed call leaves the history unchanged.
+    """
+    while True:
+        try:
+            return await agent.llm.ainvoke(history)
+        except UNAVAILABLE_ERRORS as e:
+            if not agent.running:
+                raise
+            delay = e.retry_after if isinstance(e, CircuitOpenError) else LLM_RETRY_DELAY
+            logging.warning(f"{agent.name}: LLM unavailable, retrying in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
+
+
+class MotorControlAgent(AsyncAgent):
     def __init__(self, name: str, message_bus: MessageBus):
         super().__init__(name, message_bus, self.waiting_for_plan)
         self.plan = None
         self.llm = self.message_bus.get_resource("llm")
         self.history = MessageHistory()
+        # The system prompt never changes, so every plan can reuse the server's cached prefix
+        self.history.cache_key = self.name
         self.tools = mine_tools.get_tools()
         self.tool_string = mine_tools.get_tools_string()
+        # The action chosen in execution, which runs while observation asks its next question
+        self.pending_action = None
 
         system = (
             "You are an expert AI agent playing Minecraft. "
@@ -27,12 +50,13 @@ class MotorControlAgent(ThreadedAgent):
 
         self.history.add("system", system)
 
-    def to_tool_call(self, message: str) -> str:
+    async def to_tool_call(self, message: str) -> str:
         """
         Take a message and call an LLM to convert it to a tool call,
         then call the tool and return the result.
         """
         temp_history = MessageHistory()
+        temp_history.cache_key = f"{self.name}-tool-call"
         temp_system = (
                 "You are an expert AI agent playing Minecraft. "
                 "Your task is to convert the user's message into a tool call. "
@@ -51,7 +75,7 @@ class MotorControlAgent(ThreadedAgent):
         temp_history.add("system", temp_system)
         temp_history.add("user", message)
 
-        temp_history = self.llm.invoke(temp_history)
+        temp_history = await ainvoke_until_available(self, temp_history)
 
         tool_call_message = temp_history.last()
 
@@ -59,14 +83,15 @@ class MotorControlAgent(ThreadedAgent):
 
         # logging.info(f"{self.name}: '{tool_call_message}'")
 
-        tool_call_result = mine_tools.exec_tool_call(tool_call_message)
+        # The controller API is blocking
+        tool_call_result = await asyncio.to_thread(mine_tools.exec_tool_call, tool_call_message)
 
         logging.info(f"{self.name}: '{tool_call_result}'")
 
         return tool_call_result
 
-    def waiting_for_plan(self):
-        message = self.receive_message(timeout=1)
+    async def waiting_for_plan(self):
+        message = await self.receive_message()
 
         if message:
             self.plan = message.content
@@ -77,25 +102,30 @@ class MotorControlAgent(ThreadedAgent):
 
         return self.waiting_for_plan
 
-    def observation(self):
+    async def observation(self):
         self.history.start_transaction()
 
         self.history.add("user",
                          "Ask a single question to better understand the environment. Do not provide any additional information or attempt to execute the plan. Try to ask a different question from those asked in conversation so far. It doesn't have to be completely different, but providing unique perspectives on the environment helps improve performance.")
 
-        self.history = self.llm.invoke(self.history)
+        self.history = await ainvoke_until_available(self, self.history)
         question = self.history.last()
         logging.info(f"{self.name}: '{question}'")
 
         self.history.rollback()
 
+        # The question is asked while the last action runs, its result goes before the question
+        if self.pending_action is not None:
+            self.history.add("user", await self.pending_action)
+            self.pending_action = None
+
         self.history.add("assistant", question)
-        result = self.to_tool_call(question)
+        result = await self.to_tool_call(question)
         self.history.add("assistant", result)
 
         return self.execution
 
-    def execution(self):
+    async def execution(self):
         exec_message = (
             "With the above information, describe the next action to take "
             "in order to follow the plan and complete the task. "
@@ -106,7 +136,7 @@ class MotorControlAgent(ThreadedAgent):
 
         self.history.add("user", exec_message)
 
-        self.history = self.llm.invoke(self.history)
+        self.history = await ainvoke_until_available(self, self.history)
         step = self.history.last()
 
         logging.info(f"{self.name}: '{step}'")
@@ -114,53 +144,62 @@ class MotorControlAgent(ThreadedAgent):
         if "steps complete" in step.lower():
             return self.done_or_error
 
-        tool_call_result = self.to_tool_call(step)
-
-        self.history.add("user", tool_call_result)
+        self.pending_action = asyncio.create_task(self.to_tool_call(step))
 
         return self.observation
 
-    def done_or_error(self):
+    async def done_or_error(self):
         self.send_message("ReasoningAgent", Message("user", "done"))
 
         return self.waiting_for_plan
 
 
-class ReasoningAgent(ThreadedAgent):
-    def __init__(self, name: str, message_bus: MessageBus):
+class ReasoningAgent(AsyncAgent):
+    def __init__(self, name: str, message_bus: MessageBus, goals: list[str] | None = None):
         super().__init__(name, message_bus, self.request_goal)
         self.llm = self.message_bus.get_resource("llm")
+        self.goals = goals or ["Mine a log."]
+        # Plans sent to the Motor Control Agent which it hasn't finished yet
+        self.pending_plans = 0
 
-    def request_goal(self):
+    async def request_goal(self):
         logging.info(f"{self.name}: Requesting goal")
         return self.planning
 
-    def planning(self):
+    async def planning(self):
         system = "You are the Mastermind of a team of agents playing Minecraft. Your goal is to provide the agents with a plan to complete a goal. Your team consists of you and the Motor Control Agent. The Motor Control Agent will execute the plan step by step. Write a short plan for the Motor Control Agent to follow to achieve the goal."
-        goal = "Your goal is to: Mine a log."
 
-        history = MessageHistory()
-        history.add("system", system)
-        history.add("user", goal)
+        histories = []
+        for goal in self.goals:
+            history = MessageHistory()
+            history.add("system", system)
+            history.add("user", f"Your goal is to: {goal}")
+            histories.append(history)
 
-        history = self.llm.invoke(history)
+        # The goals are planned independently, so request all plans at once
+        histories = await asyncio.gather(*(ainvoke_until_available(self, history) for history in histories))
 
-        plan = history.last()
-        logging.info(f"{self.name}: Created plan '{plan}'")
+        # The Motor Control Agent's mailbox queues the plans, it executes them in order
+        for history in histories:
+            plan = history.last()
+            logging.info(f"{self.name}: Created plan '{plan}'")
+            self.send_message("MotorControlAgent", Message("assistant", plan))
 
-        self.send_message("MotorControlAgent", Message("assistant", plan))
+        self.pending_plans = len(histories)
 
         return self.waiting_for_motor
 
-    def waiting_for_motor(self):
-        message = self.receive_message(timeout=1)
+    async def waiting_for_motor(self):
+        message = await self.receive_message()
         if message:
             logging.info(f"{self.name}: Received message '{message.content}'")
-            return self.request_goal
+            self.pending_plans -= 1
+            if self.pending_plans <= 0:
+                return self.request_goal
         return self.waiting_for_motor
 
 
-def main():
+async def run_agents():
     # Initialize MessageBus
     bus = MessageBus()
 
@@ -177,23 +216,25 @@ def main():
     motor_agent = MotorControlAgent("MotorControlAgent", bus)
     reasoning_agent = ReasoningAgent("ReasoningAgent", bus)
 
-    # Start agents
-    motor_agent.start()
-    reasoning_agent.start()
+    # Start agents, both run on this event loop
+    agents = asyncio.gather(motor_agent.run(), reasoning_agent.run())
 
     # Let the system run for a while
-    time.sleep(10000)
+    await asyncio.sleep(10000)
 
     # Stop agents
     motor_agent.stop()
     reasoning_agent.stop()
 
-    # Wait for all threads to finish
-    motor_agent.join()
-    reasoning_agent.join()
+    # Wait for all agents to finish
+    await agents
 
     logging.info("System shutdown.")
 
 
+def main():
+    asyncio.run(run_agents())
+
+
 if __name__ == "__main__":
     main()
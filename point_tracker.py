@@ -3,6 +3,11 @@ import numpy as np
 import threading
 import time
 
+# Shortest time a sample counts as current, and the longest gap between frames which is
+# used to estimate the frame interval (longer gaps come from pauses and retargets)
+MIN_SAMPLE_MAX_AGE = 0.15
+MAX_FRAME_INTERVAL = 0.5
+
 
 class PointTracker:
     """
@@ -10,15 +15,34 @@ class PointTracker:
 
     Initialize with the point to track, then call the get_latest_position method to get the
     latest position of the point. Once done, call the stop method to stop the tracking.
+
+    The tracker can be reused for new points with the retarget method, and paused in between
+    with the pause method, which keeps the capture thread alive without tracking.
     """
 
-    def __init__(self, point, headless=True):
+    def __init__(self, point, headless=True, paused=False):
         self.x_coordinate = point[0]
         self.y_coordinate = point[1]
         self.headless = headless
         self.latest_position = point
         self.running = True
 
+        # Time (time.monotonic) of the latest tracked frame. The events are set
+        # once the first frame has been tracked and every time a frame is tracked.
+        self.sample_time = 0.0
+        # Smoothed time between tracked frames, which depends on the camera's frame rate
+        self.frame_interval = 1 / 15
+        self.ready = threading.Event()
+        self.new_sample = threading.Event()
+
+        # The tracking thread picks up a pending target before tracking the next frame.
+        # The lock keeps it from publishing a sample of the old target after a retarget.
+        self.target_lock = threading.Lock()
+        self.pending_target = point
+        self.active = threading.Event()
+        if not paused:
+            self.active.set()
+
         # Initialize video capture
         self.cap = cv2.VideoCapture(0, cv2.CAP_DSHOW)
         self.image_size = (640, 480)
@@ -28,16 +52,6 @@ class PointTracker:
         self.thread.start()
 
     def _run_tracking(self):
-        # Read the first frame
-        ret, frame = self.cap.read()
-        if not ret:
-            print("Failed to read video")
-            self.cap.release()
-            return
-
-        frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        p0 = np.array([[self.x_coordinate, self.y_coordinate]], dtype=np.float32)
-
         # Parameters for Lucas-Kanade Optical Flow
         lk_params = dict(winSize=(21, 21),
                          maxLevel=3,
@@ -45,13 +59,46 @@ class PointTracker:
 
         # ORB detector for recovery
         orb = cv2.ORB_create()
-        keypoint = cv2.KeyPoint(self.x_coordinate, self.y_coordinate, 20)
-        keypoints_prev = [keypoint]
-        _, des_prev = orb.compute(frame_gray, keypoints_prev)
 
         bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
 
+        frame_gray = None
+        p0 = None
+        des_prev = None
+
         while self.running:
+            if not self.active.is_set():
+                # Keep grabbing (without decoding) while paused so that the capture
+                # buffer doesn't hold stale frames once tracking resumes
+                if not self.cap.grab():
+                    print("Failed to read video")
+                    break
+                if not self.headless:
+                    cv2.waitKey(1)
+                continue
+
+            with self.target_lock:
+                target = self.pending_target
+                self.pending_target = None
+
+            if target is not None:
+                # Read the first frame for the new target
+                ret, frame = self.cap.read()
+                if not ret:
+                    print("Failed to read video")
+                    break
+
+                self.x_coordinate, self.y_coordinate = target
+                self.latest_position = target
+
+                frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                p0 = np.array([[self.x_coordinate, self.y_coordinate]], dtype=np.float32)
+
+                keypoint = cv2.KeyPoint(self.x_coordinate, self.y_coordinate, 20)
+                keypoints_prev = [keypoint]
+                _, des_prev = orb.compute(frame_gray, keypoints_prev)
+                continue
+
             ret, frame = self.cap.read()
             if not ret:
                 break
@@ -103,10 +150,39 @@ class PointTracker:
 
             frame_gray = frame_gray_new.copy()
 
+            with self.target_lock:
+                # Drop the sample if the target changed or tracking was paused meanwhile
+                if self.pending_target is None and self.active.is_set():
+                    now = time.monotonic()
+                    interval = now - self.sample_time
+                    if interval <= MAX_FRAME_INTERVAL:
+                        self.frame_interval += 0.2 * (interval - self.frame_interval)
+                    self.sample_time = now
+                    self.new_sample.set()
+                    self.ready.set()
+
         self.running = False
         self.cap.release()
         cv2.destroyAllWindows()
 
+    def retarget(self, point):
+        """
+        Starts tracking a new point. The ready event is set once the first frame with
+        the new point has been tracked.
+        """
+        with self.target_lock:
+            self.pending_target = point
+            self.sample_time = 0.0
+            self.ready.clear()
+        self.active.set()
+
+    def pause(self):
+        """Pauses tracking until the next retarget, without stopping the capture thread."""
+        with self.target_lock:
+            self.active.clear()
+            self.sample_time = 0.0
+            self.ready.clear()
+
     def stop(self):
         """Stops the tracking process."""
         self.running = False
@@ -118,6 +194,29 @@ class PointTracker:
         """Returns the latest tracked position."""
         return self.latest_position
 
+    def try_get_latest_position(self, max_age_ms=None):
+        """
+        Returns the latest tracked position if it is at most max_age_ms old.
+        Otherwise waits up to max_age_ms for a new frame to be tracked, and
+        returns None if none arrives (the tracker has stalled or stopped).
+        By default, max_age_ms is two frames, but at least MIN_SAMPLE_MAX_AGE.
+        """
+        if max_age_ms is None:
+            max_age = max(2 * self.frame_interval, MIN_SAMPLE_MAX_AGE)
+        else:
+            max_age = max_age_ms / 1000
+
+        # Clear before checking the age, a frame tracked after the check then still sets
+        # the event, and one tracked before it has already updated sample_time
+        self.new_sample.clear()
+        if time.monotonic() - self.sample_time <= max_age:
+            return self.latest_position
+
+        if self.new_sample.wait(max_age):
+            return self.latest_position
+
+        return None
+
     def get_latest_position_in_percentage_from_center(self):
         """
         Get the latest position of the tracked point in percentage coordinates.
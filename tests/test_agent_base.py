@@ -0,0 +1,144 @@
+import asyncio
+import threading
+import unittest
+from agent_base import AsyncAgent, AsyncMailbox, Mailbox, Message, MessageBus, StateMachine
+
+
+class TestMessage(unittest.TestCase):
+
+    def test_json_round_trip(self):
+        message = Message.from_json(Message("user", "User message").to_json())
+        self.assertEqual(message.role, "user")
+        self.assertEqual(message.content, "User message")
+
+    def test_to_json_after_change(self):
+        message = Message("assistant", "Assistant message")
+        message.to_json()
+        message.role = "agent1"
+        message.content = "Changed message"
+        self.assertEqual(Message.from_json(message.to_json()).role, "agent1")
+        self.assertEqual(Message.from_json(message.to_json()).content, "Changed message")
+
+    def test_to_dict_after_change(self):
+        message = Message("assistant", "Assistant message")
+        message.to_dict()
+        message.content = "Changed message"
+        self.assertEqual(message.to_dict(), {"role": "assistant", "content": "Changed message"})
+
+
+class TestMailbox(unittest.TestCase):
+
+    def setUp(self):
+        self.mailbox = Mailbox()
+
+    def test_fifo_order(self):
+        self.mailbox.put(Message("user", "First"))
+        self.mailbox.put(Message("user", "Second"))
+        self.assertEqual(self.mailbox.get(timeout=0).content, "First")
+        self.assertEqual(self.mailbox.get(timeout=0).content, "Second")
+
+    def test_full_mailbox_drops_oldest(self):
+        mailbox = Mailbox(maxlen=2)
+        for content in ["First", "Second", "Third"]:
+            mailbox.put(Message("user", content))
+        self.assertEqual(mailbox.get(timeout=0).content, "Second")
+        self.assertEqual(mailbox.get(timeout=0).content, "Third")
+
+    def test_get_timeout_when_empty(self):
+        self.assertIsNone(self.mailbox.get(timeout=0.01))
+
+    def test_get_wakes_up_on_put(self):
+        timer = threading.Timer(0.05, self.mailbox.put, args=[Message("user", "Late message")])
+        timer.start()
+        message = self.mailbox.get(timeout=5)
+        timer.join()
+        self.assertEqual(message.content, "Late message")
+
+    def test_close_wakes_up_get(self):
+        timer = threading.Timer(0.05, self.mailbox.close)
+        timer.start()
+        message = self.mailbox.get()
+        timer.join()
+        self.assertIsNone(message)
+
+
+class TestAsyncMailbox(unittest.TestCase):
+
+    def test_get_timeout_when_empty(self):
+        self.assertIsNone(asyncio.run(AsyncMailbox().get(timeout=0.01)))
+
+    def test_get_wakes_up_on_put(self):
+        async def main():
+            mailbox = AsyncMailbox()
+            asyncio.get_running_loop().call_later(0.05, mailbox.put, Message("user", "Late message"))
+            return await mailbox.get(timeout=5)
+
+        self.assertEqual(asyncio.run(main()).content, "Late message")
+
+    def test_agents_on_one_loop(self):
+        bus = MessageBus()
+
+        class Echo(AsyncAgent):
+            def __init__(self):
+                super().__init__("echo", bus, self.echo)
+
+            async def echo(self):
+                message = await self.receive_message()
+                if message:
+                    self.send_message("test", Message("assistant", message.content))
+                return self.echo
+
+        async def main():
+            echo = Echo()
+            mailbox = bus.register_agent("test", None, AsyncMailbox)
+            task = asyncio.create_task(echo.run())
+            bus.send_message("echo", Message("user", "Hello"))
+            reply = await mailbox.get(timeout=5)
+            echo.stop()
+            await task
+            return reply
+
+        self.assertEqual(asyncio.run(main()).content, "Hello")
+
+
+class TestMessageBus(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = MessageBus()
+
+    def test_send_to_registered_agent(self):
+        mailbox = self.bus.register_agent("agent1", None)
+        self.bus.send_message("agent1", Message("user", "Hello"))
+        self.assertEqual(mailbox.get(timeout=0).content, "Hello")
+
+    def test_registration_does_not_change_snapshot(self):
+        snapshot = self.bus.agent_queues
+        self.bus.register_agent("agent1", None)
+        self.assertEqual(snapshot, {})
+        self.bus.unregister_agent("agent1")
+        self.assertNotIn("agent1", self.bus.agent_queues)
+        self.assertNotIn("agent1", self.bus.agents)
+
+
+class TestStateMachine(unittest.TestCase):
+
+    def first(self):
+        return self.second
+
+    def second(self):
+        return self.second
+
+    def test_version_counts_state_changes(self):
+        sm = StateMachine(self.first)
+        self.assertEqual(sm.version, 0)
+        sm.update()
+        self.assertEqual(sm.version, 1)
+        # Staying in the same state is not a change
+        sm.update()
+        self.assertEqual(sm.version, 1)
+        sm.set_state(self.first)
+        self.assertEqual(sm.version, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
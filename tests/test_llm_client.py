@@ -11,7 +11,7 @@ class TestMessageHistoryTransactions(unittest.TestCase):
         self.history.add("system", "System message")
         self.history.start_transaction()
         self.assertEqual(len(self.history.history_stack), 1)
-        self.assertEqual(self.history.history_stack[0][0].content, "System message")
+        self.assertEqual(self.history.history_stack[0], 1)
 
     def test_rollback_transaction(self):
         self.history.add("system", "System message")
@@ -50,6 +50,44 @@ class TestMessageHistoryTransactions(unittest.TestCase):
         self.assertEqual(len(self.history.history), 1)
         self.assertEqual(self.history.history[0].content, "System message")
 
+    def test_copy_is_independent(self):
+        self.history.add("system", "System message")
+        history_copy = self.history.copy()
+        history_copy.add("user", "User message")
+        self.assertEqual(len(self.history.history), 1)
+        self.assertEqual(len(history_copy.history), 2)
+
+    def test_frozen_prefix(self):
+        self.history.add("system", "System message")
+        self.history.freeze_prefix()
+        self.history.start_transaction()
+        self.history.add("user", "User message")
+        self.assertTrue(self.history.prefix_unchanged())
+        self.history.rollback()
+        self.assertTrue(self.history.prefix_unchanged())
+        self.history.history[0].content = "Summary"
+        self.assertFalse(self.history.prefix_unchanged())
+
+    def test_rollback_after_clear(self):
+        self.history.add("system", "System message")
+        self.history.add("user", "User message 1")
+        self.history.add("assistant", "Assistant message 1")
+        self.history.start_transaction()
+        self.history.clear_all_but_system()
+        self.history.add("user", "User message 2")
+        self.history.rollback()
+        self.assertEqual([message.content for message in self.history.history],
+                         ["System message", "User message 1", "Assistant message 1"])
+
+    def test_str_after_rollback(self):
+        self.history.add("system", "System message")
+        self.history.start_transaction()
+        self.history.add("user", "User message 1")
+        self.assertEqual(str(self.history), "SYSTEM: System message\nUSER: User message 1")
+        self.history.rollback()
+        self.history.add("user", "User message 2")
+        self.assertEqual(str(self.history), "SYSTEM: System message\nUSER: User message 2")
+
 
 class TestMessageHistoryApiFormat(unittest.TestCase):
 
@@ -118,6 +156,49 @@ class TestMessageHistoryApiFormat(unittest.TestCase):
 
         self.assertEqual(self.history.to_api_format(agent="agent1"), expected_output)
 
+    def test_to_api_format_with_system_prompt(self):
+        self.history.add("system", "System message")
+        self.history.set_system_prompt("agent1", "Agent system message")
+        self.history.set_system_prompt("agent2", "Other agent system message")
+        self.history.add("user", "User message")
+
+        expected_output = [
+            {"role": "system", "content": "System message\nAgent system message"},
+            {"role": "user", "content": "USER: User message"}
+        ]
+
+        self.assertEqual(self.history.to_api_format(agent="agent1"), expected_output)
+
+    def test_to_api_format_after_changes(self):
+        self.history.add("system", "System message")
+        self.history.add("user", "User message")
+        self.history.to_api_format()
+        self.history.add("user", "User message 2")
+        self.history.start_transaction()
+        self.history.add("assistant", "Assistant message")
+        self.history.add("user", "User message 3")
+        self.history.to_api_format()
+        self.history.rollback()
+
+        expected_output = [
+            {"role": "system", "content": "System message"},
+            {"role": "user", "content": "User message\nUser message 2"}
+        ]
+
+        self.assertEqual(self.history.to_api_format(), expected_output)
+
+    def test_view_long_run_on_copy(self):
+        self.history.add("system", "System message")
+        for i in range(20000):
+            self.history.add("user", f"User message {i}")
+        self.history.view(None)
+
+        # A copy starts without the cached view, so the whole run is merged again
+        view = self.history.copy().view(None)
+
+        self.assertEqual(len(view), 2)
+        self.assertEqual(view[1].content, "\n".join(f"User message {i}" for i in range(20000)))
+
     def test_to_api_format_empty_history(self):
         with self.assertRaises(ValueError):
             self.history.to_api_format()